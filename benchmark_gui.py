@@ -0,0 +1,192 @@
+"""
+Micro-benchmarks for the configuration GUI (save, load preset and reset to default).
+
+Results use the same JSON layout as wiz_benchmark so both can be stored as
+baselines and compared with --compare. Runs headless via Qt's offscreen
+platform, so no display, audio hardware or bulbs are required.
+"""
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+from PyQt5.QtWidgets import QApplication
+
+import volume_config_gui
+
+
+# Fixed configuration used for every run so timings stay comparable
+BENCHMARK_CONFIG = {
+    "audio": {
+        "device_index": -1,
+        "sample_rate": 48000,
+        "frames_per_buffer": 256,
+        "num_channels": 2
+    },
+    "network": {
+        "udp_port": 38899,
+        "light_ips": [f"192.168.1.{i}" for i in range(10, 26)]
+    },
+    "visualization": {
+        "beat_threshold": 1.5,
+        "color_cycle_duration_ms": 300,
+        "drum_break_threshold": 1.8,
+        "drum_break_interval_ms": 200,
+        "min_update_interval_ms": 100,
+        "upper_threshold": 0.05,
+        "lower_threshold": 0.01,
+        "beat_history_size": 5,
+        "drum_break_history_size": 10
+    },
+    "brightness": {
+        "user_brightness": 255,
+        "min_brightness": 50,
+        "enable_dynamic_brightness": True
+    },
+    "features": {
+        "enable_smoothing": False,
+        "reverse_colors": True,
+        "random_reversal_interval": False,
+        "reversal_interval": 5000,
+        "enable_interpolation": True,
+        "enable_drum_break_detection": True,
+        "enable_beat_detection": True
+    },
+    "color_settings": {
+        "vivid_colors": [[255, 0, 0], [255, 128, 0], [255, 255, 0], [0, 255, 0], [0, 0, 255], [128, 0, 255]],
+        "beat_colors": [[255, 255, 255], [0, 255, 255]],
+        "drum_break_colors": [[255, 0, 255], [255, 255, 255]]
+    },
+    "audio_processing": {
+        "max_seen_volume": 1.0,
+        "normalized_volume_factor": 1.0
+    }
+}
+
+
+def calibrate_iterations(operation, round_ms):
+    """Return how many calls make one round last about round_ms (also warms the stage up)."""
+    batch = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(batch):
+            operation()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= round_ms * 1e5:
+            return max(1, int(batch * round_ms * 1e6 / max(elapsed, 1)))
+        batch *= 2
+
+
+def time_stage(operation, iterations, rounds, round_ms):
+    """Return the fastest time per call in nanoseconds over several rounds, and the calls per round.
+
+    When iterations is None each round is sized to last round_ms. The minimum is
+    used because it is the least disturbed by other work on the machine.
+    """
+    if iterations is None:
+        iterations = calibrate_iterations(operation, round_ms)
+    else:
+        operation()
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            operation()
+        ns_per_op = (time.perf_counter_ns() - start) / iterations
+        best = ns_per_op if best is None else min(best, ns_per_op)
+    return best, iterations
+
+
+def run_benchmarks(work_dir, iterations, rounds, round_ms):
+    config_path = os.path.join(work_dir, "volume_config.json")
+    default_path = os.path.join(work_dir, "default_volume_config.json")
+    volume_config_gui.save_config(config_path, BENCHMARK_CONFIG)
+    volume_config_gui.save_config(default_path, BENCHMARK_CONFIG)
+    os.makedirs(os.path.join(work_dir, "presets"))
+    volume_config_gui.save_config(os.path.join(work_dir, "presets", "benchmark.json"),
+                                  {"visualization": BENCHMARK_CONFIG["visualization"]})
+
+    results = {}
+    # The GUI prints the full config on every save; keep it out of the terminal
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        editor = volume_config_gui.ConfigEditor(config_path, default_path)
+
+        # Go through the buttons so the signal wiring is exercised too
+        results["gui_save_config"] = time_stage(editor.save_button.click, iterations, rounds, round_ms)
+
+        editor.preset_dropdown.setCurrentText("benchmark")
+        results["gui_load_preset"] = time_stage(editor.load_preset_button.click, iterations, rounds, round_ms)
+
+        def reset_to_default():
+            # Same work as confirm_reset, minus the dialog and the network discovery
+            editor.populate_settings(volume_config_gui.load_config(default_path))
+            QApplication.processEvents()
+
+        results["gui_reset_to_default"] = time_stage(reset_to_default, iterations, rounds, round_ms)
+        editor.close()
+
+    return {name: {"ns_per_op": value, "iterations": calls} for name, (value, calls) in results.items()}
+
+
+def compare_results(baseline_path, stages, tolerance, noise_floor_ns):
+    """Print a comparison table and return the number of regressed stages.
+
+    A stage regresses when it is slower than the baseline by more than the
+    tolerance plus an absolute noise floor.
+    """
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f).get("stages", {})
+
+    regressions = 0
+    for name, result in sorted(stages.items()):
+        if name not in baseline:
+            print(f"{name:<28} no baseline")
+            continue
+        base = baseline[name]["ns_per_op"]
+        ratio = result["ns_per_op"] / base if base > 0 else 1.0
+        regressed = result["ns_per_op"] > base * (1.0 + tolerance) + noise_floor_ns
+        regressions += regressed
+        print(f"{name:<28} baseline {base:.1f} ns, current {result['ns_per_op']:.1f} ns ({ratio:.2f}x)"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the configuration GUI.")
+    parser.add_argument("--output", default="benchmark_gui_results.json")
+    parser.add_argument("--compare", help="Baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--noise-floor-ns", type=float, default=50000.0)
+    parser.add_argument("--iterations", type=int, help="Fixed calls per round instead of sizing rounds by --round-ms")
+    parser.add_argument("--round-ms", type=float, default=200.0)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    with tempfile.TemporaryDirectory() as work_dir:
+        stages = run_benchmarks(work_dir, args.iterations, args.rounds, args.round_ms)
+
+    with open(args.output, "w") as f:
+        json.dump({"input": "synthetic", "stages": stages}, f, indent=4)
+    print(f"Benchmark results written to: {args.output}")
+
+    if not args.compare:
+        for name, result in sorted(stages.items()):
+            print(f"{name:<28} {result['ns_per_op']:.1f} ns/op")
+        return 0
+
+    regressions = compare_results(args.compare, stages, args.tolerance, args.noise_floor_ns)
+    if regressions:
+        print("Performance regression detected.")
+        return 1
+    print(f"All stages within {args.tolerance * 100:.0f}% (+{args.noise_floor_ns:.0f} ns) of baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,377 @@
+"""
+Offline auto-tuner for the visualizer's detection thresholds.
+
+Replays the engine's analysis chain (RMS volume, smoothing, power transform,
+max-volume tracking, drum break and beat detection) over a folder of
+annotated tracks and searches for the settings that best match the labeled
+onsets with as few visible state changes as possible. A state change is a
+sent frame whose effect (vivid, beat or drum break) or color range differs
+from the previous frame. The engine itself sends a frame every update
+interval either way; the penalty keeps the lights from flickering. Trials run in a
+process pool across all cores. The best settings are saved as a named preset
+that the GUI can load.
+
+Corpus layout: every `track.wav` (PCM WAV) needs a `track.onsets` file next to
+it with one onset time in seconds per line. Only the first column is read, so
+Audacity label exports work as-is.
+
+Example:
+    python threshold_tuner.py corpus/ --preset club --search random --trials 300
+"""
+import os
+import sys
+import json
+import math
+import wave
+import array
+import random
+import hashlib
+import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:  # Decoding falls back to pure Python, just slower
+    numpy = None
+
+
+# Engine defaults from wiz_visualizer.cpp for settings that are not searched
+ENGINE_DEFAULTS = {
+    "beat_threshold": 1.5,
+    "drum_break_threshold": 1.8,
+    "beat_history_size": 5,
+    "drum_break_history_size": 10,
+    "upper_threshold": 0.05,
+    "lower_threshold": 0.01,
+    "color_cycle_duration_ms": 300,
+    "min_update_interval_ms": 100,
+    "drum_break_interval_ms": 200,
+    "beat_window_ms": 1000,
+    "enable_smoothing": False,
+    "enable_beat_detection": True,
+    "enable_drum_break_detection": True,
+    "idle_noise_floor": 0.001,
+    "num_colors": 6
+}
+
+# Search ranges for the tuned settings: (low, high, is_integer)
+SEARCH_SPACE = {
+    "beat_threshold": (1.1, 2.5, False),
+    "drum_break_threshold": (1.3, 3.0, False),
+    "beat_history_size": (3, 20, True),
+    "drum_break_history_size": (5, 30, True),
+    "upper_threshold": (0.01, 0.2, False),
+    "lower_threshold": (0.005, 0.05, False)
+}
+
+SMOOTHING_HISTORY_SIZE = 10
+SILENCE_THRESHOLD = 0.01
+
+
+#   CORPUS LOADING
+
+
+def load_onsets(path):
+    """Read onset times in seconds, one per line, ignoring any further columns."""
+    onsets = []
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                onsets.append(float(fields[0]))
+    return sorted(onsets)
+
+
+def decode_buffer_volumes(wav_path, frames_per_buffer):
+    """
+    Decode a WAV file into per-buffer RMS volumes on the int16 scale the engine uses.
+    Returns the volumes and the duration of one buffer in seconds.
+    """
+    with wave.open(wav_path, "rb") as wav:
+        sample_width = wav.getsampwidth()
+        channels = wav.getnchannels()
+        frame_rate = wav.getframerate()
+        raw = wav.readframes(wav.getnframes())
+
+    if sample_width != 2:
+        raise ValueError(f"{wav_path}: only 16-bit PCM WAV files are supported")
+
+    samples_per_buffer = frames_per_buffer * channels
+    volumes = []
+    if numpy is not None:
+        samples = numpy.frombuffer(raw, dtype="<i2").astype(numpy.float64)
+        usable = len(samples) - len(samples) % samples_per_buffer
+        blocks = samples[:usable].reshape(-1, samples_per_buffer)
+        volumes = numpy.sqrt((blocks * blocks).mean(axis=1)).tolist()
+    else:
+        samples = array.array("h", raw)
+        if sys.byteorder == "big":
+            samples.byteswap()
+        for start in range(0, len(samples) - samples_per_buffer + 1, samples_per_buffer):
+            block = samples[start:start + samples_per_buffer]
+            volumes.append(math.sqrt(sum(s * s for s in block) / samples_per_buffer))
+
+    return volumes, frames_per_buffer / frame_rate
+
+
+def load_track(wav_path, frames_per_buffer, cache_dir):
+    """
+    Load one annotated track, reusing decoded volumes from the cache when the
+    WAV file is unchanged.
+    """
+    stat = os.stat(wav_path)
+    key = f"{os.path.abspath(wav_path)}|{stat.st_size}|{stat.st_mtime_ns}|{frames_per_buffer}"
+    cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        volumes, buffer_seconds = cached["volumes"], cached["buffer_seconds"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        volumes, buffer_seconds = decode_buffer_volumes(wav_path, frames_per_buffer)
+        with open(cache_path, "w") as f:
+            json.dump({"volumes": volumes, "buffer_seconds": buffer_seconds}, f)
+
+    onsets = load_onsets(os.path.splitext(wav_path)[0] + ".onsets")
+    return {"name": os.path.basename(wav_path), "volumes": volumes, "buffer_seconds": buffer_seconds, "onsets": onsets}
+
+
+def find_tracks(corpus_dir):
+    """List WAV files in the corpus folder that have an onset annotation."""
+    tracks = []
+    for name in sorted(os.listdir(corpus_dir)):
+        path = os.path.join(corpus_dir, name)
+        if name.lower().endswith(".wav") and os.path.exists(os.path.splitext(path)[0] + ".onsets"):
+            tracks.append(path)
+        elif name.lower().endswith(".wav"):
+            print(f"Skipping {name}: no .onsets annotation")
+    return tracks
+
+
+#   ANALYSIS REPLAY
+
+
+def replay_track(track, settings):
+    """
+    Run the engine's analysis chain over one track.
+    Returns the detected onset times and the number of visible state changes.
+    """
+    buffer_ms = track["buffer_seconds"] * 1000.0
+    smoothing_history = deque(maxlen=SMOOTHING_HISTORY_SIZE)
+    drum_history = deque(maxlen=settings["drum_break_history_size"])
+    beat_history = deque(maxlen=settings["beat_history_size"])
+    num_ranges = max(settings["num_colors"] - 1, 1)
+
+    max_volume = 0.0
+    last_drum_ms = last_beat_ms = last_update_ms = 0.0
+    drum_active_until = beat_active_until = -1.0
+    last_sent_state = None
+    detections = []
+    state_changes = 0
+
+    for index, volume in enumerate(track["volumes"]):
+        now_ms = index * buffer_ms
+        if volume < settings["idle_noise_floor"] * 32767.0:
+            continue  # The engine skips buffers below the noise floor (volumes are on the int16 scale)
+
+        if settings["enable_smoothing"]:
+            smoothing_history.append(volume)
+            volume = sum(smoothing_history) / len(smoothing_history)
+        volume = volume ** 1.2
+
+        if volume > max_volume + settings["upper_threshold"]:
+            max_volume = volume
+        elif volume < max_volume - settings["lower_threshold"]:
+            max_volume = max(max_volume - settings["lower_threshold"], 0.0)
+
+        if volume < SILENCE_THRESHOLD:
+            continue
+
+        normalized = volume / max_volume if max_volume > 0 else 0.0
+        color_index = min(int(normalized * num_ranges), num_ranges - 1)
+
+        if settings["enable_drum_break_detection"]:
+            drum_history.append(volume)
+            average = sum(drum_history) / len(drum_history)
+            if volume > average * settings["drum_break_threshold"] and now_ms - last_drum_ms > settings["drum_break_interval_ms"]:
+                last_drum_ms = now_ms
+                drum_active_until = now_ms + settings["drum_break_interval_ms"]
+                detections.append(now_ms / 1000.0)
+
+        drum_active = now_ms < drum_active_until
+        if not drum_active and settings["enable_beat_detection"]:
+            beat_history.append(volume)
+            average = sum(beat_history) / len(beat_history)
+            if volume > average * settings["beat_threshold"] and now_ms - last_beat_ms > settings["color_cycle_duration_ms"]:
+                last_beat_ms = now_ms
+                beat_active_until = now_ms + settings["beat_window_ms"]
+                detections.append(now_ms / 1000.0)
+
+        # The engine sends every interval; count only frames that change what the lights show
+        if now_ms - last_update_ms >= settings["min_update_interval_ms"]:
+            last_update_ms = now_ms
+            state = ("drum" if drum_active else "beat" if now_ms < beat_active_until else "vivid", color_index)
+            if state != last_sent_state:
+                state_changes += 1
+                last_sent_state = state
+
+    return detections, state_changes
+
+
+def onset_f_measure(detections, onsets, tolerance_s):
+    """F-measure of detections against labeled onsets, each onset matched at most once."""
+    if not detections and not onsets:
+        return 1.0
+    if not detections or not onsets:
+        return 0.0
+
+    matched = 0
+    onset_index = 0
+    for detection in detections:
+        while onset_index < len(onsets) and onsets[onset_index] < detection - tolerance_s:
+            onset_index += 1
+        if onset_index < len(onsets) and abs(onsets[onset_index] - detection) <= tolerance_s:
+            matched += 1
+            onset_index += 1
+
+    precision = matched / len(detections)
+    recall = matched / len(onsets)
+    return 0.0 if matched == 0 else 2 * precision * recall / (precision + recall)
+
+
+#   PROCESS POOL
+
+
+_worker_tracks = []
+_worker_options = {}
+
+
+def _init_worker(tracks, options):
+    """Keep the decoded corpus in each worker so trials only ship settings."""
+    global _worker_tracks, _worker_options
+    _worker_tracks = tracks
+    _worker_options = options
+
+
+def evaluate_settings(settings):
+    """Score one setting across the whole corpus."""
+    f_measures = []
+    changes_per_second = []
+    for track in _worker_tracks:
+        detections, state_changes = replay_track(track, settings)
+        f_measures.append(onset_f_measure(detections, track["onsets"], _worker_options["tolerance_s"]))
+        duration = max(len(track["volumes"]) * track["buffer_seconds"], 1e-9)
+        changes_per_second.append(state_changes / duration)
+
+    f_measure = sum(f_measures) / len(f_measures)
+    change_rate = sum(changes_per_second) / len(changes_per_second)
+    # At most one change per sent frame
+    max_change_rate = 1000.0 / max(settings["min_update_interval_ms"], 1)
+    score = f_measure - _worker_options["change_weight"] * min(change_rate / max_change_rate, 1.0)
+    return {"settings": settings, "score": score, "f_measure": f_measure, "state_changes_per_second": change_rate}
+
+
+#   SEARCH
+
+
+def generate_trials(base_settings, search, trials, grid_steps, seed):
+    """Yield full setting dicts for a grid or random search over SEARCH_SPACE."""
+    if search == "grid":
+        axes = []
+        for key, (low, high, is_integer) in SEARCH_SPACE.items():
+            values = [low + (high - low) * i / max(grid_steps - 1, 1) for i in range(grid_steps)]
+            axes.append([int(round(v)) if is_integer else round(v, 4) for v in values])
+        for combination in itertools.product(*axes):
+            yield dict(base_settings, **dict(zip(SEARCH_SPACE, combination)))
+    else:
+        rng = random.Random(seed)
+        for _ in range(trials):
+            sample = {}
+            for key, (low, high, is_integer) in SEARCH_SPACE.items():
+                sample[key] = rng.randint(low, high) if is_integer else round(rng.uniform(low, high), 4)
+            yield dict(base_settings, **sample)
+
+
+def load_base_settings(config_path):
+    """Engine defaults, overridden by the user's config for settings that are not searched."""
+    settings = dict(ENGINE_DEFAULTS)
+    if config_path:
+        with open(config_path, "r") as f:
+            config = json.load(f)
+        for section in ("visualization", "features", "effects"):
+            for key, value in config.get(section, {}).items():
+                if key in settings:
+                    settings[key] = value
+        settings["num_colors"] = len(config.get("color_settings", {}).get("vivid_colors", [])) or settings["num_colors"]
+    return settings
+
+
+def save_preset(presets_dir, name, result):
+    """Write the tuned settings as a preset the GUI can load."""
+    os.makedirs(presets_dir, exist_ok=True)
+    preset = {
+        "name": name,
+        "visualization": {key: result["settings"][key] for key in SEARCH_SPACE},
+        "score": {
+            "score": result["score"],
+            "f_measure": result["f_measure"],
+            "state_changes_per_second": result["state_changes_per_second"]
+        }
+    }
+    path = os.path.join(presets_dir, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump(preset, f, indent=4)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune detection thresholds over a labeled audio corpus.")
+    parser.add_argument("corpus", help="Folder of .wav files with matching .onsets annotations")
+    parser.add_argument("--preset", required=True, help="Name of the preset to save")
+    parser.add_argument("--presets-dir", default="presets")
+    parser.add_argument("--config", help="volume_config.json providing the settings that are not searched")
+    parser.add_argument("--search", choices=["grid", "random"], default="random")
+    parser.add_argument("--trials", type=int, default=200, help="Number of random search trials")
+    parser.add_argument("--grid-steps", type=int, default=3, help="Values per setting for grid search")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--frames-per-buffer", type=int, default=256)
+    parser.add_argument("--tolerance-ms", type=float, default=50.0, help="Onset matching window")
+    parser.add_argument("--change-weight", type=float, default=0.1,
+                        help="Penalty per unit of visible state change rate, relative to one change per sent frame")
+    parser.add_argument("--cache-dir", default=".tuner_cache")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    track_paths = find_tracks(args.corpus)
+    if not track_paths:
+        print(f"No annotated tracks found in {args.corpus}")
+        return 1
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    tracks = [load_track(path, args.frames_per_buffer, args.cache_dir) for path in track_paths]
+    print(f"Loaded {len(tracks)} tracks")
+
+    base_settings = load_base_settings(args.config)
+    trials = list(generate_trials(base_settings, args.search, args.trials, args.grid_steps, args.seed))
+    options = {"tolerance_s": args.tolerance_ms / 1000.0, "change_weight": args.change_weight}
+    print(f"Running {len(trials)} trials on {args.workers} workers...")
+
+    best = None
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(tracks, options)) as pool:
+        chunk_size = max(1, len(trials) // (args.workers * 4))
+        for done, result in enumerate(pool.map(evaluate_settings, trials, chunksize=chunk_size), start=1):
+            if best is None or result["score"] > best["score"]:
+                best = result
+                print(f"[{done}/{len(trials)}] score {result['score']:.4f} "
+                      f"(F {result['f_measure']:.3f}, {result['state_changes_per_second']:.1f} state changes/s)")
+
+    path = save_preset(args.presets_dir, args.preset, best)
+    print(f"Best settings: {json.dumps({key: best['settings'][key] for key in SEARCH_SPACE})}")
+    print(f"Preset saved to: {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
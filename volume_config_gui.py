@@ -5,14 +5,23 @@ import threading
 import asyncio
 import ast
 import os
+import socket
+import ipaddress
 import psutil 
 import pyaudio
-import pyi_splash
+
+try:
+    import pyi_splash  # Only available inside the PyInstaller bundle
+except ImportError:
+    pyi_splash = None
 
 from PyQt5.QtGui import QColor, QIcon
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
-from PyQt5.QtWidgets import QApplication, QComboBox, QGraphicsDropShadowEffect, QGraphicsBlurEffect, QColorDialog, QWidget, QVBoxLayout, QHBoxLayout, QFormLayout, QLineEdit, QCheckBox, QPushButton, QLabel, QGroupBox, QScrollArea, QMessageBox, QListWidget, QSizePolicy
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QApplication, QComboBox, QGraphicsDropShadowEffect, QGraphicsBlurEffect, QColorDialog, QWidget, QVBoxLayout, QHBoxLayout, QFormLayout, QLineEdit, QCheckBox, QPushButton, QLabel, QGroupBox, QScrollArea, QMessageBox, QListWidget, QListWidgetItem, QAbstractItemView, QSizePolicy
 from pywizlight import discovery
+from pywizlight.utils import create_udp_broadcast_socket
+
+import wiz_trace
 
 
 def load_icon():
@@ -29,6 +38,7 @@ def load_icon():
 
     return QIcon(icon_path)
 
+@wiz_trace.traced("get_default_input_device", "audio")
 def get_default_input_device():
     """
     Get the name and index of the default audio input device (recording device) using PyAudio.
@@ -54,23 +64,115 @@ def stop_visualizer():
         visualizer_process = None
         print("Visualizer stopped.")
 
+def get_broadcast_addresses():
+    """
+    Get the directed broadcast address of every active IPv4 interface, plus the
+    limited broadcast address used by pywizlight by default.
+    """
+    addresses = {"255.255.255.255"}
+    interface_stats = psutil.net_if_stats()
+    for name, interface_addresses in psutil.net_if_addrs().items():
+        if name in interface_stats and not interface_stats[name].isup:
+            continue
+        for address in interface_addresses:
+            if address.family != socket.AF_INET or address.address.startswith("127.") or not address.netmask:
+                continue
+            network = ipaddress.IPv4Network(f"{address.address}/{address.netmask}", strict=False)
+            addresses.add(str(network.broadcast_address))
+    return sorted(addresses)
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    """Report every bulb that answers the registration broadcast."""
+
+    def __init__(self, on_bulb_found):
+        self.on_bulb_found = on_bulb_found
+
+    def datagram_received(self, data, addr):
+        try:
+            response = json.loads(data.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return
+        mac = response.get("result", {}).get("mac") if isinstance(response, dict) else None
+        if mac:
+            self.on_bulb_found(addr[0], mac)
+
+    def error_received(self, exc):
+        # Unreachable broadcast addresses on some interfaces should not stop discovery
+        print(f"Discovery socket error: {exc}")
+
+
 class DiscoveryThread(QThread):
-    # Signal to emit the discovered lights
+    # Signal emitted for each light as soon as it answers
+    light_found = pyqtSignal(str)
+    # Signal emitted with all discovered light IPs when discovery ends
     discovered = pyqtSignal(list)
+    # Signal for status messages, so the worker never touches widgets directly
+    status = pyqtSignal(str)
 
-    def __init__(self, discover_lights_async, parent=None):
+    def __init__(self, timeout=1.5, retries=3, expected_count=0, parent=None):
         super().__init__(parent)
-        self.discover_lights_async = discover_lights_async
+        self.timeout = timeout
+        self.retries = max(1, retries)
+        self.expected_count = expected_count
+        self.error = None  # Set when discovery could not run at all
 
     def run(self):
         # Run the discovery in a new event loop
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         try:
-            discovered_lights = loop.run_until_complete(self.discover_lights_async())
-            self.discovered.emit(discovered_lights)  # Emit the discovered lights
+            with wiz_trace.span("DiscoveryThread.discover", "discovery"):
+                discovered_ips = loop.run_until_complete(self.discover())
         finally:
             loop.close()
+        self.discovered.emit(discovered_ips)
+
+    async def discover(self):
+        """
+        Broadcast on every interface at once and report bulbs as they answer.
+        The broadcast is repeated up to `retries` times, waiting `timeout` seconds
+        each time, and stops early once `expected_count` lights have answered.
+        """
+        loop = asyncio.get_running_loop()
+        broadcast_addresses = get_broadcast_addresses()
+        found = {}
+        enough_found = loop.create_future()
+
+        def on_bulb_found(ip, mac):
+            if ip in found:
+                return
+            found[ip] = mac
+            self.light_found.emit(ip)
+            if self.expected_count and len(found) >= self.expected_count and not enough_found.done():
+                enough_found.set_result(None)
+
+        self.status.emit(f"Searching for connected devices on {len(broadcast_addresses)} network(s)...")
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: DiscoveryProtocol(on_bulb_found),
+                sock=create_udp_broadcast_socket(discovery.PORT)
+            )
+        except OSError as e:
+            # Usually the discovery port is taken, e.g. by another WiZ app
+            print(f"Error opening discovery socket: {e}")
+            self.error = f"Discovery failed: could not open UDP port {discovery.PORT} ({e.strerror or e})."
+            self.status.emit(self.error)
+            return []
+        try:
+            for attempt in range(self.retries):
+                for address in broadcast_addresses:
+                    transport.sendto(discovery.REGISTER_MESSAGE, (address, discovery.PORT))
+                try:
+                    await asyncio.wait_for(asyncio.shield(enough_found), self.timeout)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            transport.close()
+
+        print(f"Discovered lights: {list(found)}")  # Debugging line
+        return list(found)
 
 # Define the path to the theme effects settings file dynamically
 if getattr(sys, 'frozen', False):  # If running as a packaged app
@@ -128,6 +230,9 @@ def load_theme_effects(theme_name):
 # Global variable to keep track of the process
 visualizer_process = None
 
+# Effect stages the visualizer knows, in their default order
+EFFECT_STAGES = ["vivid_color", "dynamic_brightness", "drum_break", "beat"]
+
 # Load the configuration JSON file
 def load_config(file_path):
     with open(file_path, 'r') as f:
@@ -151,6 +256,13 @@ class ConfigEditor(QWidget):
         self.statusLabel = QLabel("WiZ Volume Visualizer Control", self)
         self.config_file = config_file
         self.default_file = default_file
+        self.stats_file = os.path.join(os.path.dirname(os.path.abspath(config_file)), "wiz_vis_stats.json")
+        self.presets_dir = os.path.join(os.path.dirname(os.path.abspath(config_file)), "presets")
+
+        # Poll the visualizer's send statistics while it is running
+        self.stats_timer = QTimer(self)
+        self.stats_timer.setInterval(1000)
+        self.stats_timer.timeout.connect(self.refresh_visualizer_stats)
 
         # Load the current configuration
         try:
@@ -160,6 +272,9 @@ class ConfigEditor(QWidget):
             QMessageBox.critical(self, "Error", "Configuration file is missing!")
             sys.exit(1)
 
+        # Opt-in tracing/profiling, see wiz_trace.py
+        wiz_trace.configure(self.config, os.path.dirname(os.path.abspath(self.config_file)))
+
 
         self.setWindowTitle("WiZ Visualizer Config Editor")
         self.setGeometry(100, 100, 600, 800)
@@ -182,7 +297,8 @@ class ConfigEditor(QWidget):
         self.top_button_layout.addWidget(self.stop_button)
 
         self.save_button = QPushButton("Save Configuration")
-        self.save_button.clicked.connect(self.save_config_to_file)
+        # clicked(bool) would pass `checked` through the traced wrapper
+        self.save_button.clicked.connect(lambda: self.save_config_to_file())
         self.top_button_layout.addWidget(self.save_button)
 
         self.reset_button = QPushButton("Reset to Default")
@@ -198,6 +314,7 @@ class ConfigEditor(QWidget):
         self.create_visualization_settings()
         self.create_brightness_settings()
         self.create_feature_settings()
+        self.create_effect_settings()
         self.create_color_settings()
         self.create_audio_processing_settings()
 
@@ -344,11 +461,42 @@ class ConfigEditor(QWidget):
         self.update_status.emit("Launching Visualizer...")
         # Save the current config before launching the visualizer
         self.save_config_to_file()
+
+        # Drop statistics left over from a previous run
+        if os.path.exists(self.stats_file):
+            os.remove(self.stats_file)
+        self.stats_timer.start()
         
         # Start the visualizer in a separate thread (with a callable method)
         thread = threading.Thread(target=self.run_visualizer_in_thread)
         thread.start()
 
+    def refresh_visualizer_stats(self):
+        """Show the visualizer's frame counters in the status label."""
+        if visualizer_process is None or visualizer_process.poll() is not None:
+            self.stats_timer.stop()
+            return
+        try:
+            with open(self.stats_file, "r") as f:
+                stats = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return  # Not written yet or caught mid-write
+        skipped = [stage['name'] for stage in stats.get('effects', []) if stage.get('skipped')]
+        self.update_status.emit(
+            ("Idle (waiting for audio) | " if stats.get('idle') else "") +
+            f"Frames sent: {stats.get('frames_sent', 0)} | "
+            f"Coalesced: {stats.get('frames_coalesced', 0)} | "
+            f"Dropped (stale): {stats.get('frames_dropped', 0)}" +
+            (f" | Over budget, skipped: {', '.join(skipped)}" if skipped else "")
+        )
+
+        rates = [
+            f"{bulb['ip']}: every {bulb['interval_ms']} ms ({bulb['acceptance'] * 100:.0f}% accepted)"
+            for bulb in stats.get('bulbs', [])
+        ]
+        if rates:
+            self.bulb_rates_label.setText("Light update rates:\n" + "\n".join(rates))
+
     def stop_visualizer_thread(self):
         """Stop the visualizer in a separate thread."""
         thread = threading.Thread(target=self.run_stop_visualizer_in_thread)
@@ -393,9 +541,47 @@ class ConfigEditor(QWidget):
             widget.setToolTip(tooltips.get(key, ""))
             setattr(self, key, widget)
 
+        # Presets written by threshold_tuner.py
+        self.preset_dropdown = QComboBox()
+        self.preset_dropdown.addItems(self.list_presets())
+        self.preset_dropdown.setToolTip("Detection presets found in the 'presets' folder.")
+        self.load_preset_button = QPushButton("Load Preset")
+        self.load_preset_button.clicked.connect(lambda: self.load_selected_preset())
+        preset_layout = QHBoxLayout()
+        preset_layout.addWidget(self.preset_dropdown)
+        preset_layout.addWidget(self.load_preset_button)
+        layout.addRow("Preset", preset_layout)
+
         visualization_group.setLayout(layout)
         self.settings_layout.addWidget(visualization_group)
 
+    def list_presets(self):
+        """Return the names of the presets in the presets folder."""
+        if not os.path.isdir(self.presets_dir):
+            return []
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(self.presets_dir) if name.endswith(".json"))
+
+    @wiz_trace.traced()
+    def load_selected_preset(self):
+        """Fill the visualization fields from the selected preset. Values are kept on Save."""
+        name = self.preset_dropdown.currentText()
+        if not name:
+            return
+        try:
+            with open(os.path.join(self.presets_dir, f"{name}.json"), "r") as f:
+                preset = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            print(f"Error loading preset {name}: {e}")
+            self.update_status.emit(f"Failed to load preset: {name}")
+            return
+
+        for key, value in preset.get("visualization", {}).items():
+            self.config["visualization"].setdefault(key, value)
+            widget = getattr(self, key, None)
+            if isinstance(widget, QLineEdit):
+                widget.setText(str(value))
+        self.update_status.emit(f"Loaded preset: {name}")
+
     def create_brightness_settings(self):
         brightness_group = QGroupBox("Brightness Settings")
         layout = QFormLayout()
@@ -429,8 +615,24 @@ class ConfigEditor(QWidget):
             "reversal_interval_max": "Maximum interval for color reversal in milliseconds.",
             "enable_drum_break_detection": "Enable detection of drum breaks.",
             "enable_beat_detection": "Enable detection of beats.",
-            "enable_tempo_based_intensity": "Enable tempo-based intensity adjustments."
+            "enable_tempo_based_intensity": "Enable tempo-based intensity adjustments.",
+            "enable_idle_mode": "Show an idle scene and stop sending updates after a period of silence.",
+            "idle_timeout_s": "Seconds below the noise floor before the visualizer goes idle.",
+            "idle_noise_floor": "Input level (RMS, 0 to 1) treated as silence.",
+            "idle_decimation": "While idle, check only every Nth frame (all channels) for returning audio.",
+            "idle_scene_id": "WiZ scene shown while idle. 0 turns the lights off."
+        }
+
+        # Idle mode settings, added to configs created before the feature existed
+        idle_defaults = {
+            "enable_idle_mode": True,
+            "idle_timeout_s": 30,
+            "idle_noise_floor": 0.001,
+            "idle_decimation": 8,
+            "idle_scene_id": 0
         }
+        for key, value in idle_defaults.items():
+            self.config["features"].setdefault(key, value)
 
         for key, value in self.config["features"].items():
             widget = QCheckBox() if isinstance(value, bool) else QLineEdit(str(value))
@@ -443,6 +645,47 @@ class ConfigEditor(QWidget):
         features_group.setLayout(layout)
         self.settings_layout.addWidget(features_group)
 
+    def create_effect_settings(self):
+        effects_group = QGroupBox("Effects")
+        layout = QFormLayout()
+
+        tooltips = {
+            "stage_budget_us": "Time budget per effect stage and frame, in microseconds.",
+            "max_overruns": "Skip a stage for a few seconds after it runs over budget this many frames in a row.",
+            "drum_color_step_ms": "Milliseconds each drum break color is shown before moving to the next.",
+            "beat_window_ms": "Milliseconds the beat colors are shown after a beat."
+        }
+
+        # Effect settings, added to configs created before the pipeline existed
+        effects = self.config.setdefault("effects", {})
+        effects.setdefault("pipeline", list(EFFECT_STAGES))
+        effects.setdefault("stage_budget_us", 1000)
+        effects.setdefault("max_overruns", 5)
+        effects.setdefault("drum_color_step_ms", 50)
+        effects.setdefault("beat_window_ms", 1000)
+
+        # Checked stages run in list order; drag to reorder
+        layout.addRow(QLabel("Pipeline (checked stages run top to bottom, drag to reorder):"))
+        self.effect_pipeline_list = QListWidget(self)
+        self.effect_pipeline_list.setDragDropMode(QAbstractItemView.InternalMove)
+        self.effect_pipeline_list.setMinimumHeight(100)
+        enabled = [name for name in effects["pipeline"] if name in EFFECT_STAGES]
+        for name in enabled + [name for name in EFFECT_STAGES if name not in enabled]:
+            item = QListWidgetItem(name)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if name in enabled else Qt.Unchecked)
+            self.effect_pipeline_list.addItem(item)
+        layout.addRow(self.effect_pipeline_list)
+
+        for key in tooltips:
+            widget = QLineEdit(str(effects[key]))
+            layout.addRow(key.replace('_', ' ').capitalize(), widget)
+            widget.setToolTip(tooltips[key])
+            setattr(self, key, widget)
+
+        effects_group.setLayout(layout)
+        self.settings_layout.addWidget(effects_group)
+
     def create_color_settings(self):
         color_group = QGroupBox("Color Settings")
         layout = QFormLayout()
@@ -576,6 +819,7 @@ class ConfigEditor(QWidget):
         self.audio_device_input.setEnabled(checked)
         self.audio_device_dropdown.setEnabled(not checked)
 
+    @wiz_trace.traced(category="audio")
     def list_audio_devices(self):
         import pyaudio
         pa = pyaudio.PyAudio()
@@ -617,6 +861,27 @@ class ConfigEditor(QWidget):
         self.udp_port = QLineEdit(str(self.config['network']['udp_port']))
         layout.addRow("Udp port", self.udp_port)
 
+        # Frames waiting longer than this are dropped instead of sent late
+        self.config['network'].setdefault('max_frame_age_ms', 250)
+        self.max_frame_age_ms = QLineEdit(str(self.config['network']['max_frame_age_ms']))
+        self.max_frame_age_ms.setToolTip("Maximum age of a pending color update in milliseconds before it is dropped.")
+        layout.addRow("Max frame age ms", self.max_frame_age_ms)
+
+        # Per-bulb update rate, adapted to how many commands each bulb acknowledges
+        self.config['network'].setdefault('enable_adaptive_rate', True)
+        self.config['network'].setdefault('adaptive_min_interval_ms', 50)
+        self.config['network'].setdefault('adaptive_max_interval_ms', 500)
+        self.enable_adaptive_rate = QCheckBox()
+        self.enable_adaptive_rate.setChecked(self.config['network']['enable_adaptive_rate'])
+        self.enable_adaptive_rate.setToolTip("Adjust each light's update interval to the rate it can sustain.")
+        layout.addRow("Enable adaptive rate", self.enable_adaptive_rate)
+        self.adaptive_min_interval_ms = QLineEdit(str(self.config['network']['adaptive_min_interval_ms']))
+        self.adaptive_min_interval_ms.setToolTip("Fastest update interval any light may be driven at, in milliseconds.")
+        layout.addRow("Adaptive min interval ms", self.adaptive_min_interval_ms)
+        self.adaptive_max_interval_ms = QLineEdit(str(self.config['network']['adaptive_max_interval_ms']))
+        self.adaptive_max_interval_ms.setToolTip("Slowest update interval a struggling light is backed off to, in milliseconds.")
+        layout.addRow("Adaptive max interval ms", self.adaptive_max_interval_ms)
+
         # Light IPs label and list
         light_ips_label = QLabel("Light IPs:")
         layout.addRow(light_ips_label)
@@ -632,6 +897,33 @@ class ConfigEditor(QWidget):
 
         layout.addRow(self.light_ip_list)
 
+        # Discovery behaviour for the Auto Detect button
+        discovery_settings = {
+            "discovery_timeout_s": (1.5, "Seconds to wait for answers after each discovery broadcast."),
+            "discovery_retries": (3, "Number of times the discovery broadcast is sent."),
+            "discovery_expected_count": (0, "Stop discovery once this many lights have answered (0 waits for all retries).")
+        }
+        for key, (default, tooltip) in discovery_settings.items():
+            self.config['network'].setdefault(key, default)
+            widget = QLineEdit(str(self.config['network'][key]))
+            widget.setToolTip(tooltip)
+            layout.addRow(key.replace('_', ' ').capitalize(), widget)
+            setattr(self, key, widget)
+
+        # Optional Prometheus-style metrics served by the visualizer on 127.0.0.1
+        self.config['network'].setdefault('enable_metrics', False)
+        self.config['network'].setdefault('metrics_port', 9109)
+        self.enable_metrics = QCheckBox()
+        self.enable_metrics.setChecked(self.config['network']['enable_metrics'])
+        self.enable_metrics.setToolTip("Serve visualizer metrics at http://127.0.0.1:<port>/metrics while it runs.")
+        layout.addRow("Enable metrics", self.enable_metrics)
+        self.metrics_port = QLineEdit(str(self.config['network']['metrics_port']))
+        self.metrics_port.setToolTip("Loopback port for the metrics endpoint.")
+        layout.addRow("Metrics port", self.metrics_port)
+
+        # Update rates chosen by the visualizer, filled in while it runs
+        self.bulb_rates_label = QLabel("Light update rates: visualizer not running")
+        layout.addRow(self.bulb_rates_label)
 
         # Manual IP entry
         self.light_ip_input = QLineEdit(self)
@@ -678,30 +970,43 @@ class ConfigEditor(QWidget):
                 self.light_ip_list.takeItem(self.light_ip_list.row(item))
 
     def add_discovered_lights(self):
+        # Only one discovery at a time
+        if getattr(self, 'discovery_thread', None) is not None and self.discovery_thread.isRunning():
+            return
+
+        def read_setting(key, cast, default):
+            try:
+                return cast(getattr(self, key).text())
+            except (AttributeError, ValueError):
+                return default
+
         # Create and start the discovery thread
-        self.discovery_thread = DiscoveryThread(self.discover_lights_async)
-        self.discovery_thread.discovered.connect(self.handle_discovered_lights)
+        self.discovery_thread = DiscoveryThread(
+            timeout=read_setting('discovery_timeout_s', float, 1.5),
+            retries=read_setting('discovery_retries', int, 3),
+            expected_count=read_setting('discovery_expected_count', int, 0)
+        )
+        self.discovery_thread.light_found.connect(self.handle_discovered_light)
+        self.discovery_thread.discovered.connect(self.handle_discovery_finished)
+        self.discovery_thread.status.connect(self.update_status_label)
         self.discovery_thread.start()
 
-    def handle_discovered_lights(self, discovered_lights):
-        # Update the GUI with the discovered lights
-        for light in discovered_lights:
-            if hasattr(light, 'ip') and light.ip not in self.config['network']['light_ips']:
-                self.config['network']['light_ips'].append(light.ip)
-                self.light_ip_list.addItem(light.ip)
+    def handle_discovered_light(self, ip):
+        # Add each light to the list as soon as it answers
+        if ip not in self.config['network']['light_ips']:
+            self.config['network']['light_ips'].append(ip)
+            self.light_ip_list.addItem(ip)
 
-    async def discover_lights_async(self):
-        self.statusLabel.setText("Searching for connected devices...")
-        # Discover WiZ lights asynchronously
-        discovered_lights = await discovery.discover_lights()
-        print(f"Discovered lights: {discovered_lights}")  # Debugging line
-        self.statusLabel.setText("WiZ Volume Visualizer Control")
-        return discovered_lights
+    def handle_discovery_finished(self, discovered_ips):
+        if self.discovery_thread.error:
+            return  # Keep the failure message in the status
+        self.update_status_label(f"Discovery finished: {len(discovered_ips)} light(s) answered.")
   
 
 #   CONFIGURATION SAVE/LOAD/RESET
 
 
+    @wiz_trace.traced()
     def save_config_to_file(self):
         self.statusLabel.setText("Saving...")
         
@@ -709,6 +1014,12 @@ class ConfigEditor(QWidget):
         self.config['network']['udp_port'] = int(self.udp_port.text())  # Save the udp_port from the form
         self.config['network']['light_ips'] = [self.light_ip_list.item(i).text() for i in range(self.light_ip_list.count())]
 
+        # Update the effect pipeline from the checked stages, in list order
+        self.config['effects']['pipeline'] = [
+            self.effect_pipeline_list.item(i).text() for i in range(self.effect_pipeline_list.count())
+            if self.effect_pipeline_list.item(i).checkState() == Qt.Checked
+        ]
+
         # Update the config dictionary with the current widget values
         for section, data in self.config.items():
             for key, value in data.items():
@@ -792,6 +1103,7 @@ class ConfigEditor(QWidget):
 
             print("Configuration reset to default.")
 
+    @wiz_trace.traced()
     def populate_settings(self, config):
         # Clear current UI elements first
         for i in reversed(range(self.settings_layout.count())):
@@ -808,6 +1120,7 @@ class ConfigEditor(QWidget):
         self.create_visualization_settings()
         self.create_brightness_settings()
         self.create_feature_settings()
+        self.create_effect_settings()
         self.create_color_settings()
         self.create_audio_processing_settings()
 
@@ -826,7 +1139,8 @@ class ConfigEditor(QWidget):
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     theme_name = sys.argv[1] if len(sys.argv) > 1 else "dark"
-    pyi_splash.close()
+    if pyi_splash is not None:
+        pyi_splash.close()
 
     # Determine the base path
     if getattr(sys, 'frozen', False):  # Packaged app
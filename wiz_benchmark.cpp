@@ -0,0 +1,456 @@
+// Micro-benchmarks for every stage of the visualizer pipeline.
+//
+// Runs on synthetic audio (default) or a recorded raw float32 capture and
+// writes the results as a JSON baseline. With --compare the run fails when a
+// stage is slower than the stored baseline by more than the tolerance plus an
+// absolute noise floor.
+// No audio hardware or bulbs are needed: UDP commands go to a loopback
+// simulator that lives inside this process.
+#define WIZ_VISUALIZER_NO_MAIN
+#include "wiz_visualizer.cpp"
+
+#include <algorithm>
+#include <filesystem>
+#include <functional>
+#include <iomanip>
+#include <map>
+#include <sstream>
+
+struct BenchmarkOptions
+{
+    std::string output_path = "benchmark_results.json";
+    std::string compare_path;
+    std::string input_path;
+    double tolerance = 0.25;
+    double noise_floor_ns = 5.0;
+    size_t iterations = 0; // 0 sizes each round to round_ms
+    double round_ms = 20.0;
+    int rounds = 5;
+    int bulbs = 4;
+};
+
+struct BenchmarkResult
+{
+    double ns_per_op = 0.0;
+    size_t iterations = 0;
+};
+
+// Stream buffer that swallows the pipeline's debug output while timing
+class NullBuffer : public std::streambuf
+{
+protected:
+    int overflow(int c) override { return c; }
+};
+
+// Deterministic noise bed with a kick-like burst every 24 buffers
+std::vector<std::vector<int16_t>> make_synthetic_buffers(size_t count)
+{
+    std::mt19937 synth_rng(42);
+    std::uniform_real_distribution<float> noise(-0.05f, 0.05f);
+    std::vector<std::vector<int16_t>> buffers(count);
+    size_t samples = static_cast<size_t>(FRAMES_PER_BUFFER) * NUM_CHANNELS;
+
+    for (size_t b = 0; b < count; ++b)
+    {
+        float gain = (b % 24 == 0) ? 0.9f : 0.2f + 0.1f * std::sin(b * 0.05f);
+        buffers[b].resize(samples);
+        for (size_t i = 0; i < samples; ++i)
+        {
+            float tone = std::sin(2.0f * 3.14159265f * 110.0f * i / 48000.0f);
+            buffers[b][i] = static_cast<int16_t>(clamp(gain * tone + noise(synth_rng), -1.0f, 1.0f) * 32767.0f);
+        }
+    }
+    return buffers;
+}
+
+// Recorded input is raw interleaved float32 PCM with NUM_CHANNELS channels
+std::vector<std::vector<int16_t>> load_recorded_buffers(const std::string &path)
+{
+    std::ifstream input(path, std::ios::binary);
+    std::vector<std::vector<int16_t>> buffers;
+    if (!input)
+    {
+        std::cerr << "Could not open recorded input: " << path << std::endl;
+        return buffers;
+    }
+
+    size_t samples = static_cast<size_t>(FRAMES_PER_BUFFER) * NUM_CHANNELS;
+    std::vector<float> block(samples);
+    while (input.read(reinterpret_cast<char *>(block.data()), samples * sizeof(float)))
+    {
+        std::vector<int16_t> buffer(samples);
+        for (size_t i = 0; i < samples; ++i)
+            buffer[i] = static_cast<int16_t>(clamp(block[i], -1.0f, 1.0f) * 32767.0f);
+        buffers.push_back(std::move(buffer));
+    }
+    return buffers;
+}
+
+double elapsed_ns(std::chrono::steady_clock::time_point start)
+{
+    return static_cast<double>(std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now() - start).count());
+}
+
+// Iterations needed for one round to take about round_ms; also warms the stage up
+size_t calibrate_iterations(const std::function<void(size_t)> &op, const BenchmarkOptions &options)
+{
+    if (options.iterations > 0)
+    {
+        for (size_t i = 0; i < options.iterations / 10; ++i)
+            op(i);
+        return options.iterations;
+    }
+
+    double target_ns = options.round_ms * 1e6;
+    for (size_t batch = 1;; batch *= 2)
+    {
+        auto start = std::chrono::steady_clock::now();
+        for (size_t i = 0; i < batch; ++i)
+            op(i);
+        double batch_ns = elapsed_ns(start);
+        if (batch_ns >= target_ns / 10 || batch >= (size_t(1) << 30))
+            return std::max<size_t>(1, static_cast<size_t>(batch * target_ns / std::max(batch_ns, 1.0)));
+    }
+}
+
+// Fastest time per call over several rounds. The minimum is the least
+// disturbed by scheduling and frequency changes, so it is the most repeatable.
+BenchmarkResult time_stage(const std::function<void(size_t)> &op, const BenchmarkOptions &options)
+{
+    size_t iterations = calibrate_iterations(op, options);
+
+    double best = 0.0;
+    for (int round = 0; round < options.rounds; ++round)
+    {
+        auto start = std::chrono::steady_clock::now();
+        for (size_t i = 0; i < iterations; ++i)
+            op(i);
+        double ns_per_op = elapsed_ns(start) / iterations;
+        best = round == 0 ? ns_per_op : std::min(best, ns_per_op);
+    }
+    return {best, iterations};
+}
+
+// Receives setPilot datagrams on 127.0.0.1 and answers like a bulb would
+class LoopbackSimulator
+{
+public:
+    LoopbackSimulator()
+        : socket_(io_context_, udp::endpoint(boost::asio::ip::address_v4::loopback(), 0))
+    {
+        worker_ = std::thread([this]() {
+            char data[1024];
+            udp::endpoint sender;
+            const std::string ack = "{\"method\":\"setPilot\",\"env\":\"sim\",\"result\":{\"success\":true}}";
+            while (!stopping_)
+            {
+                boost::system::error_code ec;
+                socket_.receive_from(boost::asio::buffer(data), sender, 0, ec);
+                if (ec || stopping_)
+                    continue;
+                received_++;
+                socket_.send_to(boost::asio::buffer(ack), sender, 0, ec);
+            }
+        });
+    }
+
+    ~LoopbackSimulator()
+    {
+        stopping_ = true;
+        boost::system::error_code ec;
+        udp::socket waker(io_context_, udp::endpoint(udp::v4(), 0));
+        waker.send_to(boost::asio::buffer("stop", 4), socket_.local_endpoint(), 0, ec);
+        worker_.join();
+    }
+
+    int port() const { return socket_.local_endpoint().port(); }
+    size_t received() const { return received_; }
+
+private:
+    boost::asio::io_context io_context_;
+    udp::socket socket_;
+    std::thread worker_;
+    std::atomic<bool> stopping_{false};
+    std::atomic<size_t> received_{0};
+};
+
+std::map<std::string, BenchmarkResult> run_benchmarks(const std::vector<std::vector<int16_t>> &buffers, const BenchmarkOptions &options)
+{
+    std::map<std::string, BenchmarkResult> results;
+    size_t count = buffers.size();
+
+    vivid_colors = {{255, 0, 0}, {255, 128, 0}, {255, 255, 0}, {0, 255, 0}, {0, 0, 255}, {128, 0, 255}};
+    beat_colors = {{255, 255, 255}, {0, 255, 255}};
+    drum_break_colors = {{255, 0, 255}, {255, 255, 255}};
+    enable_smoothing = false;
+    enable_interpolation = true;
+
+    // Volumes as the callback would see them, reused by the downstream stages
+    std::vector<float> volumes;
+    for (const auto &buffer : buffers)
+        volumes.push_back(process_audio(buffer));
+    max_volume = std::max(*std::max_element(volumes.begin(), volumes.end()), 1.0f);
+
+    volatile float sink = 0.0f;
+
+    results["rms_volume"] = time_stage([&](size_t i) {
+        sink = calculate_initial_volume(buffers[i % count]);
+    }, options);
+
+    results["moving_average_smoothing"] = time_stage([&](size_t i) {
+        sink = smooth_volume(volumes[i % count]);
+    }, options);
+
+    results["beat_detection"] = time_stage([&](size_t i) {
+        sink = detect_beat(volumes[i % count]);
+    }, options);
+
+    results["drum_break_detection"] = time_stage([&](size_t i) {
+        sink = detect_drum_break(volumes[i % count]);
+    }, options);
+
+    results["color_lookup"] = time_stage([&](size_t i) {
+        sink = static_cast<float>(get_vivid_color_from_volume(volumes[i % count])[0]);
+    }, options);
+
+    build_effect_pipeline();
+    FrameState frame;
+    results["effect_pipeline"] = time_stage([&](size_t i) {
+        frame.volume = volumes[i % count];
+        frame.brightness = user_brightness.load();
+        frame.now = std::chrono::steady_clock::now();
+        run_effect_pipeline(frame);
+        sink = static_cast<float>(frame.brightness);
+    }, options);
+
+    results["trace_span_disabled"] = time_stage([&](size_t) {
+        TraceSpan span("benchmark");
+    }, options);
+
+    results["metrics_counter"] = time_stage([&](size_t) {
+        count_metric(local_metrics().callbacks);
+    }, options);
+
+    std::vector<float> quiet_input(static_cast<size_t>(FRAMES_PER_BUFFER) * NUM_CHANNELS, 0.0001f);
+    results["idle_energy_check"] = time_stage([&](size_t) {
+        sink = decimated_rms(quiet_input.data(), FRAMES_PER_BUFFER, NUM_CHANNELS, IDLE_DECIMATION);
+    }, options);
+
+    std::vector<int> color = {255, 128, 0};
+    results["set_pilot_encoding"] = time_stage([&](size_t i) {
+        sink = static_cast<float>(build_set_pilot_payload(color, static_cast<int>(i % 256)).size());
+    }, options);
+
+    light_ips.assign(options.bulbs, "127.0.0.1");
+    results["frame_enqueue"] = time_stage([&](size_t i) {
+        queue_frame(color, static_cast<int>(i % 256));
+    }, options);
+
+    // The real sender thread against the simulator, which acknowledges every command.
+    // Bulbs are paced at a fixed min_update_interval_ms so each stage is repeatable.
+    LoopbackSimulator simulator;
+    UDP_PORT = simulator.port();
+    STATS_FILE_PATH = (std::filesystem::temp_directory_path() / "wiz_benchmark_stats.json").string();
+    enable_adaptive_rate = false;
+    auto time_sender = [&](int interval_ms, const std::function<BenchmarkResult()> &measure) {
+        MIN_UPDATE_INTERVAL_MS = interval_ms;
+        frame_slots.assign(light_ips.size(), PendingFrame());
+        running = true;
+        std::thread sender(udp_sender_loop);
+
+        // Wait for the sender to deliver one frame before timing
+        size_t target = simulator.received() + light_ips.size();
+        auto deadline = std::chrono::steady_clock::now() + std::chrono::seconds(1);
+        queue_frame(color, 0);
+        while (simulator.received() < target && std::chrono::steady_clock::now() < deadline)
+            std::this_thread::yield();
+
+        BenchmarkResult result = measure();
+        running = false;
+        frame_ready.notify_one();
+        sender.join();
+        return result;
+    };
+
+    // Queue a frame and wait until every bulb has received it
+    results["udp_fanout"] = time_sender(0, [&]() {
+        return time_stage([&](size_t i) {
+            size_t target = simulator.received() + light_ips.size();
+            auto deadline = std::chrono::steady_clock::now() + std::chrono::seconds(1);
+            queue_frame(color, static_cast<int>(i % 256));
+            while (simulator.received() < target && std::chrono::steady_clock::now() < deadline)
+                std::this_thread::yield();
+        }, options);
+    });
+
+    // Flood queue_frame for FLOOD_DURATION_MS per round while the sender drains every
+    // 5 ms, so producer and sender contend for the latest-wins slots. Most frames
+    // are replaced before their bulb is due (normal pacing, not counted as coalesced).
+    const int FLOOD_DURATION_MS = 200;
+    uint64_t coalesced_before = 0;
+    size_t received_before = 0;
+    results["udp_fanout_coalesced"] = time_sender(5, [&]() {
+        received_before = simulator.received();
+        coalesced_before = frames_coalesced;
+        double best = 0.0;
+        size_t total_ops = 0;
+        for (int round = 0; round < options.rounds; ++round)
+        {
+            size_t ops = 0;
+            auto start = std::chrono::steady_clock::now();
+            auto end = start + std::chrono::milliseconds(FLOOD_DURATION_MS);
+            auto now = start;
+            while (now < end)
+            {
+                for (int batch = 0; batch < 64; ++batch)
+                    queue_frame(color, static_cast<int>(ops++ % 256));
+                now = std::chrono::steady_clock::now();
+            }
+            double ns_per_op = static_cast<double>(std::chrono::duration_cast<std::chrono::nanoseconds>(now - start).count()) / ops;
+            best = round == 0 ? ns_per_op : std::min(best, ns_per_op);
+            total_ops += ops;
+        }
+        return BenchmarkResult{best, total_ops};
+    });
+
+    size_t sent_during_flood = simulator.received() - received_before;
+    std::cerr << "udp_fanout_coalesced: " << sent_during_flood << " commands sent during the flood, "
+              << frames_coalesced - coalesced_before << " overdue frames coalesced" << std::endl;
+    if (sent_during_flood == 0)
+        throw std::runtime_error("udp_fanout_coalesced: the sender delivered no commands during the flood");
+
+    (void)sink;
+    return results;
+}
+
+void write_results(const std::string &path, const std::string &input_name, const std::map<std::string, BenchmarkResult> &results, const BenchmarkOptions &options)
+{
+    json output;
+    output["input"] = input_name;
+    output["frames_per_buffer"] = FRAMES_PER_BUFFER;
+    output["num_channels"] = NUM_CHANNELS;
+    output["bulbs"] = options.bulbs;
+    for (const auto &entry : results)
+    {
+        output["stages"][entry.first]["ns_per_op"] = entry.second.ns_per_op;
+        output["stages"][entry.first]["iterations"] = entry.second.iterations;
+    }
+
+    std::ofstream file(path);
+    file << output.dump(4) << std::endl;
+}
+
+// Returns the number of stages that regressed beyond the tolerance. The noise
+// floor keeps stages of a few nanoseconds from failing on timer jitter.
+int compare_results(const std::string &baseline_path, const std::map<std::string, BenchmarkResult> &results, const BenchmarkOptions &options)
+{
+    std::ifstream file(baseline_path);
+    if (!file)
+    {
+        std::cerr << "Could not open baseline file: " << baseline_path << std::endl;
+        return -1;
+    }
+
+    json baseline;
+    file >> baseline;
+
+    int regressions = 0;
+    for (const auto &entry : results)
+    {
+        if (!baseline["stages"].contains(entry.first))
+        {
+            std::cerr << std::setw(28) << std::left << entry.first << " no baseline" << std::endl;
+            continue;
+        }
+
+        double base = baseline["stages"][entry.first]["ns_per_op"].get<double>();
+        double ratio = base > 0.0 ? entry.second.ns_per_op / base : 1.0;
+        bool regressed = entry.second.ns_per_op > base * (1.0 + options.tolerance) + options.noise_floor_ns;
+        if (regressed)
+            regressions++;
+
+        std::cerr << std::setw(28) << std::left << entry.first
+                  << std::fixed << std::setprecision(1)
+                  << " baseline " << base << " ns, current " << entry.second.ns_per_op << " ns ("
+                  << std::setprecision(2) << ratio << "x)"
+                  << (regressed ? "  REGRESSION" : "") << std::endl;
+    }
+    return regressions;
+}
+
+int main(int argc, char *argv[])
+{
+    BenchmarkOptions options;
+    for (int i = 1; i < argc; ++i)
+    {
+        std::string arg = argv[i];
+        bool has_value = i + 1 < argc;
+        if (arg == "--output" && has_value)
+            options.output_path = argv[++i];
+        else if (arg == "--compare" && has_value)
+            options.compare_path = argv[++i];
+        else if (arg == "--input" && has_value)
+            options.input_path = argv[++i];
+        else if (arg == "--tolerance" && has_value)
+            options.tolerance = std::stod(argv[++i]);
+        else if (arg == "--noise-floor-ns" && has_value)
+            options.noise_floor_ns = std::stod(argv[++i]);
+        else if (arg == "--iterations" && has_value)
+            options.iterations = std::stoul(argv[++i]);
+        else if (arg == "--round-ms" && has_value)
+            options.round_ms = std::stod(argv[++i]);
+        else if (arg == "--rounds" && has_value)
+            options.rounds = std::stoi(argv[++i]);
+        else if (arg == "--bulbs" && has_value)
+            options.bulbs = std::stoi(argv[++i]);
+        else
+        {
+            std::cerr << "Usage: wiz_benchmark [--output results.json] [--compare baseline.json] [--tolerance 0.25]"
+                      << " [--noise-floor-ns 5] [--input capture.raw] [--round-ms 20] [--iterations N] [--rounds N] [--bulbs N]" << std::endl;
+            return 2;
+        }
+    }
+
+    auto buffers = options.input_path.empty() ? make_synthetic_buffers(512) : load_recorded_buffers(options.input_path);
+    if (buffers.empty())
+    {
+        std::cerr << "No audio buffers to benchmark." << std::endl;
+        return 2;
+    }
+
+    // The pipeline logs every step; keep that out of the terminal but inside the timings
+    NullBuffer null_buffer;
+    std::streambuf *original_cout = std::cout.rdbuf(&null_buffer);
+    std::map<std::string, BenchmarkResult> results;
+    try
+    {
+        results = run_benchmarks(buffers, options);
+    }
+    catch (const std::exception &e)
+    {
+        std::cout.rdbuf(original_cout);
+        std::cerr << "Benchmark failed: " << e.what() << std::endl;
+        return 1;
+    }
+    std::cout.rdbuf(original_cout);
+
+    std::string input_name = options.input_path.empty() ? "synthetic" : options.input_path;
+    write_results(options.output_path, input_name, results, options);
+    std::cout << "Benchmark results written to: " << options.output_path << std::endl;
+
+    if (options.compare_path.empty())
+    {
+        for (const auto &entry : results)
+            std::cout << std::setw(28) << std::left << entry.first << " " << entry.second.ns_per_op << " ns/op" << std::endl;
+        return 0;
+    }
+
+    int regressions = compare_results(options.compare_path, results, options);
+    if (regressions != 0)
+    {
+        std::cerr << (regressions < 0 ? "Comparison failed." : "Performance regression detected.") << std::endl;
+        return 1;
+    }
+    std::cout << "All stages within " << options.tolerance * 100 << "% (+" << options.noise_floor_ns << " ns) of baseline." << std::endl;
+    return 0;
+}
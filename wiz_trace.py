@@ -0,0 +1,138 @@
+"""
+Opt-in tracing and profiling for the configuration GUI.
+
+Tracing records begin/end spans for GUI actions and writes them as Chrome
+trace event JSON (open it in chrome://tracing or https://ui.perfetto.dev).
+Profiling runs each traced action under cProfile and dumps one .prof file per
+call (open it with `python -m pstats` or snakeviz).
+
+Both are off by default and cost one flag check per traced call when off.
+Enable them with environment variables, which the visualizer engine reads too:
+    WIZ_TRACE=1           trace, writing next to the config file
+    WIZ_TRACE=<folder>    trace, writing into <folder>
+    WIZ_TRACE=0           no tracing, even if the config enables it
+    WIZ_PROFILE=1         cProfile GUI actions, writing next to the config file
+    WIZ_PROFILE=<folder>  cProfile GUI actions, writing into <folder>
+    WIZ_PROFILE=0         no profiling, even if the config enables it
+or in volume_config.json:
+    "debug": {"enable_tracing": true, "enable_profiling": false}
+"""
+import os
+import json
+import time
+import atexit
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager
+
+
+GUI_TRACE_FILE = "wiz_gui_trace.json"
+OFF_VALUES = ("0", "false", "no")
+
+_tracing = False
+_profiling = False
+_trace_path = None
+_profile_dir = None
+_events = []
+_events_lock = threading.Lock()
+_active_profile = threading.local()  # Only the outermost traced call is profiled
+_start_ns = time.perf_counter_ns()
+
+
+def _output_dir(value, default_dir):
+    """An environment value of '1' means the default folder, anything else is a folder."""
+    return default_dir if value in ("1", "true", "yes") else value
+
+
+def configure(config, default_dir):
+    """Enable tracing and profiling from the environment or the config's 'debug' section."""
+    global _tracing, _profiling, _trace_path, _profile_dir
+    debug = config.get("debug", {})
+
+    trace_env = os.environ.get("WIZ_TRACE", "")
+    if trace_env not in OFF_VALUES and (trace_env or debug.get("enable_tracing", False)):
+        trace_dir = _output_dir(trace_env, default_dir) if trace_env else default_dir
+        os.makedirs(trace_dir, exist_ok=True)
+        _trace_path = os.path.join(trace_dir, GUI_TRACE_FILE)
+        if not _tracing:
+            atexit.register(write_trace)
+        _tracing = True
+        print(f"Tracing enabled, writing to: {_trace_path}")
+
+    profile_env = os.environ.get("WIZ_PROFILE", "")
+    if profile_env not in OFF_VALUES and (profile_env or debug.get("enable_profiling", False)):
+        _profile_dir = _output_dir(profile_env, default_dir) if profile_env else default_dir
+        os.makedirs(_profile_dir, exist_ok=True)
+        _profiling = True
+        print(f"Profiling enabled, writing to: {_profile_dir}")
+
+
+def _record(name, category, start_ns, end_ns):
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": (start_ns - _start_ns) / 1000.0,
+        "dur": (end_ns - start_ns) / 1000.0,
+        "pid": os.getpid(),
+        "tid": threading.get_ident()
+    }
+    with _events_lock:
+        _events.append(event)
+
+
+@contextmanager
+def span(name, category="gui"):
+    """Record the enclosed block as one trace span."""
+    if not _tracing:
+        yield
+        return
+    start_ns = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        _record(name, category, start_ns, time.perf_counter_ns())
+
+
+def traced(name=None, category="gui"):
+    """Decorator that traces, and optionally profiles, every call of a function."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (_tracing or _profiling):
+                return func(*args, **kwargs)
+
+            profiler = None
+            if _profiling and not getattr(_active_profile, "running", False):
+                profiler = cProfile.Profile()
+                _active_profile.running = True
+            start_ns = time.perf_counter_ns()
+            if profiler:
+                profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profiler:
+                    profiler.disable()
+                    _active_profile.running = False
+                    profile_name = f"{span_name.replace('.', '_')}-{time.strftime('%Y%m%d-%H%M%S')}-{start_ns}.prof"
+                    profiler.dump_stats(os.path.join(_profile_dir, profile_name))
+                if _tracing:
+                    _record(span_name, category, start_ns, time.perf_counter_ns())
+        return wrapper
+    return decorator
+
+
+def write_trace(path=None):
+    """Write all recorded spans as Chrome trace event JSON."""
+    path = path or _trace_path
+    if not path:
+        return
+    with _events_lock:
+        events = list(_events)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    print(f"Trace written to: {path}")
@@ -8,13 +8,25 @@
 #include <chrono>
 #include <deque>
 #include <numeric>
+#include <mutex>
+#include <condition_variable>
+#include <cstdlib>
+#include <functional>
 #include "json.hpp"
 #include <fstream>
 #include "portaudio.h"
+#include <array>
+#include <memory>
+#include <sstream>
+#include <cerrno>
+#include <cstring>
 #ifdef _WIN32
 #include <Windows.h>
+#include <psapi.h>
+#include <direct.h>
 #else
 #include <unistd.h>
+#include <sys/stat.h>
 #endif
 
 // Declare global variables
@@ -46,7 +58,7 @@ bool reverse_colors = true;
 bool random_reversal_interval = false;
 bool enable_drum_break_detection = false; // Added for drum break detection
 bool enable_beat_detection = false; // Added for beat detection
-int DRUM_BREAK_INTERVAL_MS = 200; // Example value, adjust as needed
+int DRUM_BREAK_INTERVAL_MS = 200; // Will be loaded from config
 int reversal_interval = 5000;
 int beat_index = 0; // Added for beat effect
 std::mt19937 rng(std::chrono::steady_clock::now().time_since_epoch().count());
@@ -61,9 +73,79 @@ int UDP_PORT = 38899;             // Will be loaded from config
 int FRAMES_PER_BUFFER = 256;      // Will be loaded from config
 int NUM_CHANNELS = 2;             // Will be loaded from config
 int MIN_UPDATE_INTERVAL_MS = 100; // Will be loaded from config
+int MAX_FRAME_AGE_MS = 250;       // Will be loaded from config
+bool enable_adaptive_rate = true;   // Will be loaded from config
+int ADAPTIVE_MIN_INTERVAL_MS = 50;  // Will be loaded from config
+int ADAPTIVE_MAX_INTERVAL_MS = 500; // Will be loaded from config
+const int ADAPTIVE_WINDOW_MS = 1000;
+const int ADAPTIVE_MIN_SAMPLES = 5;
+
+bool enable_idle_mode = true;     // Will be loaded from config
+float IDLE_TIMEOUT_S = 30.0f;     // Will be loaded from config
+float IDLE_NOISE_FLOOR = 0.001f;  // RMS of the float input, will be loaded from config
+int IDLE_DECIMATION = 8;          // Will be loaded from config
+int IDLE_SCENE_ID = 0;            // WiZ scene shown while idle, 0 turns the lights off
+std::atomic<bool> is_idle(false);
+std::atomic<bool> idle_scene_requested(false);
+auto last_sound_time = std::chrono::steady_clock::now();
 int userDeviceIndex = -1;         // will be loaded from config
 
+// Effect pipeline. Each named stage reads and updates one FrameState that is
+// reused for every buffer. Stages run in the order given by
+// effects.pipeline in the config; a stage that exceeds its time budget
+// EFFECT_MAX_OVERRUNS times in a row is skipped for EFFECT_COOLDOWN_MS.
+struct FrameState
+{
+    float volume = 0.0f;
+    std::vector<int> color = std::vector<int>(3);
+    int brightness = 0;
+    std::chrono::steady_clock::time_point now;
+};
+
+typedef void (*EffectFunction)(FrameState &frame);
+typedef void (*EffectReset)();
+
+// A stage the pipeline can be built from. Stages that are not skippable
+// (the base color) always run; reset clears any effect left active when a
+// stage is skipped.
+struct EffectDefinition
+{
+    std::string name;
+    EffectFunction run;
+    EffectReset reset;
+    bool skippable;
+};
+
+struct EffectStage
+{
+    std::string name;
+    EffectFunction run;
+    EffectReset reset;
+    bool skippable;
+    long long budget_us;
+    int consecutive_overruns = 0;
+    std::chrono::steady_clock::time_point skipped_until;
+    std::atomic<bool> skipped{false};
+    std::atomic<uint64_t> runs{0};
+    std::atomic<uint64_t> total_us{0};
+    std::atomic<uint64_t> times_skipped{0};
+
+    EffectStage(const EffectDefinition &definition, long long budget)
+        : name(definition.name), run(definition.run), reset(definition.reset),
+          skippable(definition.skippable), budget_us(budget) {}
+};
+
+std::deque<EffectStage> effect_pipeline;    // deque: stages hold atomics and are never moved
+std::vector<std::string> effect_pipeline_names = {"vivid_color", "dynamic_brightness", "drum_break", "beat"}; // Will be loaded from config
+json effect_stage_budgets = json::object(); // Optional per-stage budgets in microseconds
+long long EFFECT_BUDGET_US = 1000; // Will be loaded from config
+int EFFECT_MAX_OVERRUNS = 5;      // Will be loaded from config
+const int EFFECT_COOLDOWN_MS = 5000;
+int DRUM_COLOR_STEP_MS = 50;      // Will be loaded from config
+int BEAT_WINDOW_MS = 1000;        // Will be loaded from config
+
 std::string LIGHT_IP = "192.168.1.65"; // Will be loaded from config
+std::string STATS_FILE_PATH = "wiz_vis_stats.json"; // Placed next to the config file in main
 
 std::vector<std::vector<int>> vivid_colors;
 std::vector<std::vector<int>> beat_colors;
@@ -83,6 +165,110 @@ void log_debug(const std::string &message) {
     }
 }
 
+// Opt-in tracing, enabled with WIZ_TRACE or "debug": {"enable_tracing": true}.
+// Spans are written as Chrome trace events in JSON array format, appended as
+// the engine runs so the file stays usable when the process is terminated.
+std::atomic<bool> tracing_enabled(false);
+
+// Create a folder and any missing parents (C++14, so no std::filesystem)
+bool create_directories(const std::string &path, std::string &error)
+{
+    for (std::string::size_type end = 0; end != std::string::npos;)
+    {
+        end = path.find_first_of("\\/", end + 1);
+        std::string partial = path.substr(0, end);
+        if (partial.empty() || partial.back() == ':')
+            continue; // Root or drive letter
+#ifdef _WIN32
+        int result = _mkdir(partial.c_str());
+#else
+        int result = mkdir(partial.c_str(), 0755);
+#endif
+        if (result != 0 && errno != EEXIST)
+        {
+            error = std::strerror(errno);
+            return false;
+        }
+    }
+    return true;
+}
+std::string TRACE_FILE_PATH = "wiz_vis_trace.json";
+const auto trace_start_time = std::chrono::steady_clock::now();
+
+struct TraceEvent
+{
+    const char *name;
+    long long start_us;
+    long long duration_us;
+    size_t thread_id;
+};
+
+std::vector<TraceEvent> trace_events;
+std::mutex trace_mutex;
+bool trace_file_started = false;
+
+void record_trace_event(const char *name, std::chrono::steady_clock::time_point start, std::chrono::steady_clock::time_point end)
+{
+    TraceEvent event{
+        name,
+        std::chrono::duration_cast<std::chrono::microseconds>(start - trace_start_time).count(),
+        std::chrono::duration_cast<std::chrono::microseconds>(end - start).count(),
+        std::hash<std::thread::id>{}(std::this_thread::get_id()) % 1000000
+    };
+    std::lock_guard<std::mutex> lock(trace_mutex);
+    trace_events.push_back(event);
+}
+
+// Append recorded spans to the trace file; called periodically by the sender thread
+void flush_trace_events()
+{
+    if (!tracing_enabled)
+        return;
+
+    std::vector<TraceEvent> pending;
+    {
+        std::lock_guard<std::mutex> lock(trace_mutex);
+        pending.swap(trace_events);
+    }
+
+    std::ofstream trace_file(TRACE_FILE_PATH, trace_file_started ? std::ios::app : std::ios::trunc);
+    if (!trace_file)
+        return;
+    if (!trace_file_started)
+    {
+        trace_file << "[\n";
+        trace_file_started = true;
+    }
+    for (const auto &event : pending)
+    {
+        trace_file << "{\"name\":\"" << event.name << "\",\"cat\":\"engine\",\"ph\":\"X\",\"ts\":" << event.start_us
+                   << ",\"dur\":" << event.duration_us << ",\"pid\":0,\"tid\":" << event.thread_id << "},\n";
+    }
+}
+
+// Records the lifetime of the enclosing scope as one span; a single flag check when tracing is off
+class TraceSpan
+{
+public:
+    explicit TraceSpan(const char *name)
+        : name_(name), active_(tracing_enabled.load(std::memory_order_relaxed))
+    {
+        if (active_)
+            start_ = std::chrono::steady_clock::now();
+    }
+
+    ~TraceSpan()
+    {
+        if (active_)
+            record_trace_event(name_, start_, std::chrono::steady_clock::now());
+    }
+
+private:
+    const char *name_;
+    bool active_;
+    std::chrono::steady_clock::time_point start_;
+};
+
 
 
 
@@ -141,6 +327,7 @@ float max_volume_seen = 1e4f; // Initialize max_volume_seen to a reasonable star
 
 float process_audio(const std::vector<int16_t> &audio_data)
 {
+    TraceSpan span("process_audio");
     float volume = calculate_initial_volume(audio_data);
     std::cout << "Initial Volume: " << volume << std::endl; // Debugging
 
@@ -181,9 +368,10 @@ float process_audio(const std::vector<int16_t> &audio_data)
     return volume;
 }
 
-std::vector<int> vivid_interpolate_color(const std::vector<int> &color1, const std::vector<int> &color2, float factor, bool interpolationEnabled)
+// Writes into `color` so callers can reuse one buffer across frames
+void vivid_interpolate_color(const std::vector<int> &color1, const std::vector<int> &color2, float factor, bool interpolationEnabled, std::vector<int> &color)
 {
-    std::vector<int> color(3);
+    color.resize(3);
 
     if (!interpolationEnabled) {
         // If interpolation is disabled, return color1 directly
@@ -191,7 +379,8 @@ std::vector<int> vivid_interpolate_color(const std::vector<int> &color1, const s
                   << "R: " << color1[0] 
                   << " G: " << color1[1] 
                   << " B: " << color1[2] << std::endl;
-        return color1;
+        color.assign(color1.begin(), color1.end());
+        return;
     }
 
     for (int i = 0; i < 3; ++i)
@@ -204,12 +393,19 @@ std::vector<int> vivid_interpolate_color(const std::vector<int> &color1, const s
               << "R: " << color[0] 
               << " G: " << color[1] 
               << " B: " << color[2] << std::endl;
+}
 
+std::vector<int> vivid_interpolate_color(const std::vector<int> &color1, const std::vector<int> &color2, float factor, bool interpolationEnabled)
+{
+    std::vector<int> color(3);
+    vivid_interpolate_color(color1, color2, factor, interpolationEnabled, color);
     return color;
 }
 
-std::vector<int> get_vivid_color_from_volume(float volume)
+// Writes into `vivid_color` so callers can reuse one buffer across frames
+void get_vivid_color_from_volume(float volume, std::vector<int> &vivid_color)
 {
+    TraceSpan span("color_lookup");
     float normalized_volume = volume / max_volume;
 
     auto now = std::chrono::steady_clock::now();
@@ -232,63 +428,603 @@ std::vector<int> get_vivid_color_from_volume(float volume)
     int start_idx = idx % vivid_colors.size();
     int end_idx = (start_idx + 1) % vivid_colors.size();
     
-    std::vector<int> vivid_color = vivid_interpolate_color(vivid_colors[start_idx], vivid_colors[end_idx], factor, enable_interpolation);
+    vivid_interpolate_color(vivid_colors[start_idx], vivid_colors[end_idx], factor, enable_interpolation, vivid_color);
 
     std::cout << "Volume: " << volume 
               << ", Normalized Volume: " << normalized_volume 
               << ", Vivid Color: R: " << vivid_color[0] 
               << " G: " << vivid_color[1] 
               << " B: " << vivid_color[2] << std::endl;
+}
 
+std::vector<int> get_vivid_color_from_volume(float volume)
+{
+    std::vector<int> vivid_color(3);
+    get_vivid_color_from_volume(volume, vivid_color);
     return vivid_color;
 }
-void send_udp_command(const std::vector<int> &color, int volume)
+// Define a custom clamp function
+template <typename T>
+T clamp(const T& value, const T& min, const T& max) {
+    if (value < min)
+        return min;
+    else if (value > max)
+        return max;
+    else
+        return value;
+}
+
+// Encode a setPilot command for the given color and dimming level. "state"
+// switches the bulb back on after the idle scene (or the user) turned it off.
+std::string build_set_pilot_payload(const std::vector<int> &color, int volume)
+{
+    json payload;
+    payload["method"] = "setPilot";
+    payload["params"]["state"] = true;
+    payload["params"]["r"] = color[0];
+    payload["params"]["g"] = color[1];
+    payload["params"]["b"] = color[2];
+    payload["params"]["dimming"] = volume;
+
+    return payload.dump();
+}
+
+// Metrics for the optional loopback /metrics endpoint. Each thread owns a
+// block of counters that only it writes (relaxed load + store, no locked
+// instructions); blocks are summed only when the endpoint is scraped.
+bool enable_metrics = false; // Will be loaded from config
+int METRICS_PORT = 9109;     // Will be loaded from config
+const int METRICS_READ_TIMEOUT_MS = 1000;
+
+using boost::asio::ip::tcp;
+
+// Upper bounds of the send latency histogram buckets, in seconds
+const std::array<double, 9> SEND_LATENCY_BUCKETS = {0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5};
+
+struct ThreadMetrics
+{
+    std::atomic<uint64_t> callbacks{0};
+    std::atomic<uint64_t> silent_buffers{0};
+    std::atomic<uint64_t> beats{0};
+    std::atomic<uint64_t> drum_breaks{0};
+    std::vector<std::atomic<uint64_t>> packets_sent;
+    std::vector<std::atomic<uint64_t>> packets_failed;
+    std::array<std::atomic<uint64_t>, SEND_LATENCY_BUCKETS.size() + 1> latency_buckets{};
+    std::atomic<uint64_t> latency_sum_us{0};
+
+    explicit ThreadMetrics(size_t bulb_count) : packets_sent(bulb_count), packets_failed(bulb_count) {}
+};
+
+std::vector<std::shared_ptr<ThreadMetrics>> metrics_registry;
+std::mutex metrics_registry_mutex;
+
+// Counters of the calling thread, registered on first use
+ThreadMetrics &local_metrics()
+{
+    thread_local std::shared_ptr<ThreadMetrics> metrics = [] {
+        auto created = std::make_shared<ThreadMetrics>(light_ips.size());
+        std::lock_guard<std::mutex> lock(metrics_registry_mutex);
+        metrics_registry.push_back(created);
+        return created;
+    }();
+    return *metrics;
+}
+
+// Only the owning thread writes, so a plain load + store is enough
+inline void count_metric(std::atomic<uint64_t> &counter, uint64_t amount = 1)
+{
+    counter.store(counter.load(std::memory_order_relaxed) + amount, std::memory_order_relaxed);
+}
+
+void record_packet(size_t bulb, bool sent, std::chrono::steady_clock::duration latency)
+{
+    ThreadMetrics &metrics = local_metrics();
+    if (bulb >= metrics.packets_sent.size())
+        return;
+    if (!sent)
+    {
+        count_metric(metrics.packets_failed[bulb]);
+        return;
+    }
+    count_metric(metrics.packets_sent[bulb]);
+
+    double seconds = std::chrono::duration<double>(latency).count();
+    size_t bucket = 0;
+    while (bucket < SEND_LATENCY_BUCKETS.size() && seconds > SEND_LATENCY_BUCKETS[bucket])
+        bucket++;
+    count_metric(metrics.latency_buckets[bucket]);
+    count_metric(metrics.latency_sum_us, std::chrono::duration_cast<std::chrono::microseconds>(latency).count());
+}
+
+// Process CPU time in seconds and resident memory in bytes
+void read_process_usage(double &cpu_seconds, uint64_t &rss_bytes)
+{
+    cpu_seconds = 0.0;
+    rss_bytes = 0;
+#ifdef _WIN32
+    FILETIME creation, exit, kernel, user;
+    if (GetProcessTimes(GetCurrentProcess(), &creation, &exit, &kernel, &user))
+    {
+        auto to_seconds = [](const FILETIME &time) {
+            return ((static_cast<uint64_t>(time.dwHighDateTime) << 32) | time.dwLowDateTime) / 1e7;
+        };
+        cpu_seconds = to_seconds(kernel) + to_seconds(user);
+    }
+    PROCESS_MEMORY_COUNTERS memory;
+    if (GetProcessMemoryInfo(GetCurrentProcess(), &memory, sizeof(memory)))
+        rss_bytes = memory.WorkingSetSize;
+#else
+    std::ifstream stat_file("/proc/self/stat");
+    std::string stat_line;
+    if (std::getline(stat_file, stat_line))
+    {
+        // Fields after the parenthesised command name; utime and stime are the 12th and 13th
+        std::istringstream fields(stat_line.substr(stat_line.rfind(')') + 2));
+        std::string field;
+        unsigned long long utime = 0, stime = 0;
+        for (int i = 1; i <= 13 && fields >> field; ++i)
+        {
+            if (i == 12)
+                utime = std::stoull(field);
+            else if (i == 13)
+                stime = std::stoull(field);
+        }
+        cpu_seconds = static_cast<double>(utime + stime) / sysconf(_SC_CLK_TCK);
+    }
+    std::ifstream statm_file("/proc/self/statm");
+    unsigned long long total_pages = 0, resident_pages = 0;
+    if (statm_file >> total_pages >> resident_pages)
+        rss_bytes = resident_pages * static_cast<uint64_t>(sysconf(_SC_PAGESIZE));
+#endif
+}
+
+// Sum every thread's counters into Prometheus text exposition format
+std::string render_metrics()
+{
+    uint64_t callbacks = 0, silent_buffers = 0, beats = 0, drum_breaks = 0, latency_sum_us = 0;
+    std::vector<uint64_t> packets_sent(light_ips.size()), packets_failed(light_ips.size());
+    std::array<uint64_t, SEND_LATENCY_BUCKETS.size() + 1> latency_buckets{};
+    {
+        std::lock_guard<std::mutex> lock(metrics_registry_mutex);
+        for (const auto &metrics : metrics_registry)
+        {
+            callbacks += metrics->callbacks.load(std::memory_order_relaxed);
+            silent_buffers += metrics->silent_buffers.load(std::memory_order_relaxed);
+            beats += metrics->beats.load(std::memory_order_relaxed);
+            drum_breaks += metrics->drum_breaks.load(std::memory_order_relaxed);
+            latency_sum_us += metrics->latency_sum_us.load(std::memory_order_relaxed);
+            for (size_t i = 0; i < packets_sent.size() && i < metrics->packets_sent.size(); ++i)
+            {
+                packets_sent[i] += metrics->packets_sent[i].load(std::memory_order_relaxed);
+                packets_failed[i] += metrics->packets_failed[i].load(std::memory_order_relaxed);
+            }
+            for (size_t i = 0; i < latency_buckets.size(); ++i)
+                latency_buckets[i] += metrics->latency_buckets[i].load(std::memory_order_relaxed);
+        }
+    }
+
+    std::ostringstream out;
+    auto counter = [&out](const char *name, const char *help, uint64_t value) {
+        out << "# HELP " << name << " " << help << "\n# TYPE " << name << " counter\n" << name << " " << value << "\n";
+    };
+    counter("wiz_audio_callbacks_total", "Audio callbacks processed.", callbacks);
+    counter("wiz_silent_buffers_total", "Audio buffers skipped as silence.", silent_buffers);
+    counter("wiz_beats_total", "Beats detected.", beats);
+    counter("wiz_drum_breaks_total", "Drum breaks detected.", drum_breaks);
+
+    out << "# HELP wiz_udp_packets_sent_total UDP commands sent per bulb.\n# TYPE wiz_udp_packets_sent_total counter\n";
+    for (size_t i = 0; i < packets_sent.size(); ++i)
+        out << "wiz_udp_packets_sent_total{bulb=\"" << light_ips[i] << "\"} " << packets_sent[i] << "\n";
+    out << "# HELP wiz_udp_packets_failed_total UDP commands that failed to send per bulb.\n# TYPE wiz_udp_packets_failed_total counter\n";
+    for (size_t i = 0; i < packets_failed.size(); ++i)
+        out << "wiz_udp_packets_failed_total{bulb=\"" << light_ips[i] << "\"} " << packets_failed[i] << "\n";
+
+    out << "# HELP wiz_send_latency_seconds Time from a frame being produced to it being sent.\n# TYPE wiz_send_latency_seconds histogram\n";
+    uint64_t cumulative = 0;
+    for (size_t i = 0; i < SEND_LATENCY_BUCKETS.size(); ++i)
+    {
+        cumulative += latency_buckets[i];
+        out << "wiz_send_latency_seconds_bucket{le=\"" << SEND_LATENCY_BUCKETS[i] << "\"} " << cumulative << "\n";
+    }
+    cumulative += latency_buckets.back();
+    out << "wiz_send_latency_seconds_bucket{le=\"+Inf\"} " << cumulative << "\n";
+    out << "wiz_send_latency_seconds_sum " << latency_sum_us / 1e6 << "\n";
+    out << "wiz_send_latency_seconds_count " << cumulative << "\n";
+
+    out << "# HELP wiz_effect_stage_seconds_total Time spent running each effect stage.\n# TYPE wiz_effect_stage_seconds_total counter\n";
+    for (const auto &stage : effect_pipeline)
+        out << "wiz_effect_stage_seconds_total{stage=\"" << stage.name << "\"} " << stage.total_us.load(std::memory_order_relaxed) / 1e6 << "\n";
+    out << "# HELP wiz_effect_stage_skipped_total Frames on which each effect stage was skipped for running over budget.\n# TYPE wiz_effect_stage_skipped_total counter\n";
+    for (const auto &stage : effect_pipeline)
+        out << "wiz_effect_stage_skipped_total{stage=\"" << stage.name << "\"} " << stage.times_skipped.load(std::memory_order_relaxed) << "\n";
+
+    double cpu_seconds;
+    uint64_t rss_bytes;
+    read_process_usage(cpu_seconds, rss_bytes);
+    out << "# HELP process_cpu_seconds_total Total user and system CPU time spent in seconds.\n# TYPE process_cpu_seconds_total counter\n"
+        << "process_cpu_seconds_total " << cpu_seconds << "\n";
+    out << "# HELP process_resident_memory_bytes Resident memory size in bytes.\n# TYPE process_resident_memory_bytes gauge\n"
+        << "process_resident_memory_bytes " << rss_bytes << "\n";
+
+    return out.str();
+}
+
+// Minimal HTTP server on 127.0.0.1 answering GET /metrics
+void metrics_server_loop()
 {
     try
     {
         boost::asio::io_context io_context;
-        udp::socket socket(io_context, udp::endpoint(udp::v4(), 0));
-        udp::resolver resolver(io_context);
+        tcp::acceptor acceptor(io_context, tcp::endpoint(boost::asio::ip::address_v4::loopback(), METRICS_PORT));
+        acceptor.non_blocking(true);
+        log_debug("Metrics endpoint listening on http://127.0.0.1:" + std::to_string(METRICS_PORT) + "/metrics");
 
-        for (const auto &ip : light_ips)
+        while (running)
         {
-            udp::endpoint receiver_endpoint = *resolver.resolve(udp::v4(), ip, std::to_string(UDP_PORT)).begin();
+            tcp::socket client(io_context);
+            boost::system::error_code ec;
+            acceptor.accept(client, ec);
+            if (ec == boost::asio::error::would_block || ec == boost::asio::error::try_again)
+            {
+                std::this_thread::sleep_for(std::chrono::milliseconds(50));
+                continue;
+            }
+            if (ec)
+                continue;
+
+            client.non_blocking(false);
+
+            // Read the request with a deadline so a client that sends nothing cannot
+            // stall later scrapes or keep main from joining this thread
+            boost::asio::streambuf request(8192);
+            bool request_read = false;
+            boost::asio::steady_timer deadline(io_context, std::chrono::milliseconds(METRICS_READ_TIMEOUT_MS));
+            boost::asio::async_read_until(client, request, "\r\n\r\n", [&](const boost::system::error_code &read_ec, size_t) {
+                request_read = !read_ec;
+                deadline.cancel();
+            });
+            deadline.async_wait([&](const boost::system::error_code &wait_ec) {
+                if (!wait_ec)
+                    client.close(ec);
+            });
+            io_context.restart();
+            io_context.run();
+            if (!request_read)
+                continue;
+
+            std::string request_line;
+            std::istream request_stream(&request);
+            std::getline(request_stream, request_line);
+
+            std::string response;
+            if (request_line.rfind("GET /metrics", 0) == 0)
+            {
+                std::string body = render_metrics();
+                response = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " +
+                           std::to_string(body.size()) + "\r\nConnection: close\r\n\r\n" + body;
+            }
+            else
+            {
+                response = "HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n";
+            }
+            boost::asio::write(client, boost::asio::buffer(response), ec);
+        }
+    }
+    catch (std::exception &e)
+    {
+        std::cerr << "Metrics endpoint error: " << e.what() << std::endl;
+    }
+}
 
-            json payload;
-            payload["method"] = "setPilot";
-            payload["params"]["r"] = color[0];
-            payload["params"]["g"] = color[1];
-            payload["params"]["b"] = color[2];
-            payload["params"]["dimming"] = volume;
+// Latest-wins frame slot, one per bulb. A newer frame overwrites an unsent
+// one so a congested network never builds up a backlog of stale colors.
+struct PendingFrame
+{
+    std::vector<int> color = std::vector<int>(3);
+    int brightness = 0;
+    std::chrono::steady_clock::time_point created;
+    std::chrono::steady_clock::time_point due; // When the bulb can next be sent to, kept by the sender
+    bool pending = false;
+};
+
+std::vector<PendingFrame> frame_slots;
+std::mutex frame_mutex;
+std::condition_variable frame_ready;
+bool frames_waiting = false;
+
+std::atomic<uint64_t> frames_sent(0);
+std::atomic<uint64_t> frames_coalesced(0);
+std::atomic<uint64_t> frames_dropped(0);
+
+// Scene sent once when the engine goes idle
+std::string build_idle_scene_payload()
+{
+    json payload;
+    payload["method"] = "setPilot";
+    if (IDLE_SCENE_ID > 0)
+        payload["params"]["sceneId"] = IDLE_SCENE_ID;
+    else
+        payload["params"]["state"] = false;
+
+    return payload.dump();
+}
+
+// Stop sending frames and ask the sender thread to show the idle scene
+void enter_idle_mode()
+{
+    {
+        std::lock_guard<std::mutex> lock(frame_mutex);
+        for (auto &slot : frame_slots)
+            slot.pending = false;
+        is_idle = true;
+        idle_scene_requested = true;
+    }
+    frame_ready.notify_one();
+}
 
-            std::string message = payload.dump();
-            socket.send_to(boost::asio::buffer(message), receiver_endpoint);
+// Hand a frame to the sender thread without waiting for the network
+void queue_frame(const std::vector<int> &color, int brightness)
+{
+    TraceSpan span("queue_frame");
+    auto now = std::chrono::steady_clock::now();
+    {
+        std::lock_guard<std::mutex> lock(frame_mutex);
+        frame_slots.resize(light_ips.size());
+        for (auto &slot : frame_slots)
+        {
+            // Frames replaced before their bulb is due are normal pacing; only
+            // count those the sender should already have sent (backpressure)
+            if (slot.pending && now >= slot.due)
+                frames_coalesced++;
+            slot.color.assign(color.begin(), color.end());
+            slot.brightness = brightness;
+            slot.created = now;
+            slot.pending = true;
         }
+        frames_waiting = true;
     }
-    catch (std::exception &e)
+    frame_ready.notify_one();
+}
+
+// Per-bulb update rate, adapted to how many commands the bulb acknowledges
+struct BulbRate
+{
+    int interval_ms = 100;
+    std::chrono::steady_clock::time_point last_send;
+    int sent_in_window = 0;
+    int acked_in_window = 0;
+    float acceptance = 1.0f;
+};
+
+std::vector<BulbRate> bulb_rates; // Owned by the sender thread
+
+int initial_bulb_interval()
+{
+    if (!enable_adaptive_rate)
+        return MIN_UPDATE_INTERVAL_MS;
+    return clamp(MIN_UPDATE_INTERVAL_MS, ADAPTIVE_MIN_INTERVAL_MS, ADAPTIVE_MAX_INTERVAL_MS);
+}
+
+// Speed up bulbs that accept nearly everything, back off from bulbs that drop commands
+void adapt_bulb_rates()
+{
+    for (auto &rate : bulb_rates)
     {
-        std::cerr << "Error sending UDP command: " << e.what() << std::endl;
+        if (rate.sent_in_window < ADAPTIVE_MIN_SAMPLES)
+            continue;
+
+        float window_acceptance = std::min(1.0f, static_cast<float>(rate.acked_in_window) / rate.sent_in_window);
+        rate.acceptance = 0.5f * rate.acceptance + 0.5f * window_acceptance;
+        rate.sent_in_window = 0;
+        rate.acked_in_window = 0;
+
+        if (rate.acceptance >= 0.95f)
+            rate.interval_ms -= std::max(1, rate.interval_ms / 10);
+        else if (rate.acceptance < 0.8f)
+            rate.interval_ms = rate.interval_ms * 3 / 2 + 1;
+
+        rate.interval_ms = clamp(rate.interval_ms, ADAPTIVE_MIN_INTERVAL_MS, ADAPTIVE_MAX_INTERVAL_MS);
     }
 }
 
+// Count setPilot acknowledgements waiting on the (non-blocking) sender socket
+void drain_acknowledgements(udp::socket &socket, const std::vector<udp::endpoint> &endpoints)
+{
+    char data[512];
+    udp::endpoint sender;
+    boost::system::error_code ec;
+    while (true)
+    {
+        size_t length = socket.receive_from(boost::asio::buffer(data), sender, 0, ec);
+        if (ec)
+            return; // would_block once the socket is empty
 
-// Define a custom clamp function
-template <typename T>
-T clamp(const T& value, const T& min, const T& max) {
-    if (value < min)
-        return min;
-    else if (value > max)
-        return max;
-    else
-        return value;
+        if (std::string(data, length).find("\"success\":true") == std::string::npos)
+            continue;
+
+        for (size_t i = 0; i < endpoints.size(); ++i)
+        {
+            if (endpoints[i] == sender)
+            {
+                bulb_rates[i].acked_in_window++;
+                break;
+            }
+        }
+    }
+}
+
+void write_sender_stats()
+{
+    json stats;
+    stats["frames_sent"] = frames_sent.load();
+    stats["frames_coalesced"] = frames_coalesced.load();
+    stats["frames_dropped"] = frames_dropped.load();
+    stats["idle"] = is_idle.load();
+    stats["effects"] = json::array();
+    for (const auto &stage : effect_pipeline)
+    {
+        uint64_t runs = stage.runs.load();
+        stats["effects"].push_back({
+            {"name", stage.name},
+            {"avg_us", runs ? static_cast<double>(stage.total_us.load()) / runs : 0.0},
+            {"budget_us", stage.budget_us},
+            {"skipped", stage.skipped.load()},
+            {"skipped_frames", stage.times_skipped.load()}
+        });
+    }
+    stats["bulbs"] = json::array();
+    for (size_t i = 0; i < bulb_rates.size() && i < light_ips.size(); ++i)
+    {
+        stats["bulbs"].push_back({
+            {"ip", light_ips[i]},
+            {"interval_ms", bulb_rates[i].interval_ms},
+            {"acceptance", bulb_rates[i].acceptance}
+        });
+    }
+
+    std::ofstream stats_file(STATS_FILE_PATH, std::ios::trunc);
+    if (stats_file)
+        stats_file << stats.dump() << std::endl;
 }
 
+// Sends the newest pending frame per bulb once that bulb's interval has passed
+// and drops frames older than MAX_FRAME_AGE_MS
+void udp_sender_loop()
+{
+    boost::asio::io_context io_context;
+    udp::socket socket(io_context, udp::endpoint(udp::v4(), 0));
+    socket.non_blocking(true);
+    udp::resolver resolver(io_context);
+
+    std::vector<udp::endpoint> endpoints;
+    for (const auto &ip : light_ips)
+    {
+        try
+        {
+            endpoints.push_back(*resolver.resolve(udp::v4(), ip, std::to_string(UDP_PORT)).begin());
+        }
+        catch (std::exception &e)
+        {
+            std::cerr << "Error resolving light IP " << ip << ": " << e.what() << std::endl;
+            endpoints.push_back(udp::endpoint());
+        }
+    }
+
+    BulbRate initial_rate;
+    initial_rate.interval_ms = initial_bulb_interval();
+    bulb_rates.assign(light_ips.size(), initial_rate);
+
+    std::vector<PendingFrame> ready(light_ips.size());
+    auto last_stats_write = std::chrono::steady_clock::now();
+    auto last_adapt_time = last_stats_write;
+    auto next_wakeup = last_stats_write + std::chrono::milliseconds(500);
+    write_sender_stats();
+
+    while (running)
+    {
+        {
+            std::unique_lock<std::mutex> lock(frame_mutex);
+            frame_ready.wait_until(lock, next_wakeup, [] { return frames_waiting || idle_scene_requested || !running; });
+            frames_waiting = false;
+
+            auto now = std::chrono::steady_clock::now();
+            next_wakeup = now + std::chrono::milliseconds(500);
+            frame_slots.resize(light_ips.size());
+            for (size_t i = 0; i < frame_slots.size(); ++i)
+            {
+                ready[i].pending = false;
+                auto due = bulb_rates[i].last_send + std::chrono::milliseconds(bulb_rates[i].interval_ms);
+                frame_slots[i].due = due;
+                if (!frame_slots[i].pending)
+                    continue;
+
+                // Leave the frame in its slot until this bulb is due; newer frames keep replacing it
+                if (now < due)
+                {
+                    next_wakeup = std::min(next_wakeup, due);
+                    continue;
+                }
+
+                ready[i].color.assign(frame_slots[i].color.begin(), frame_slots[i].color.end());
+                ready[i].brightness = frame_slots[i].brightness;
+                ready[i].created = frame_slots[i].created;
+                ready[i].pending = true;
+                frame_slots[i].pending = false;
+                frame_slots[i].due = now + std::chrono::milliseconds(bulb_rates[i].interval_ms);
+            }
+        }
+
+        auto now = std::chrono::steady_clock::now();
+        TraceSpan send_span("send_frames");
+        for (size_t i = 0; i < ready.size(); ++i)
+        {
+            if (!ready[i].pending || endpoints[i].port() == 0)
+                continue;
+
+            auto age = std::chrono::duration_cast<std::chrono::milliseconds>(now - ready[i].created);
+            if (age.count() > MAX_FRAME_AGE_MS)
+            {
+                frames_dropped++;
+                continue;
+            }
+
+            boost::system::error_code ec;
+            std::string message = build_set_pilot_payload(ready[i].color, ready[i].brightness);
+            socket.send_to(boost::asio::buffer(message), endpoints[i], 0, ec);
+            record_packet(i, !ec, std::chrono::steady_clock::now() - ready[i].created);
+            if (ec)
+            {
+                std::cerr << "Error sending UDP command to " << light_ips[i] << ": " << ec.message() << std::endl;
+                continue;
+            }
+            frames_sent++;
+            bulb_rates[i].last_send = now;
+            bulb_rates[i].sent_in_window++;
+        }
+
+        if (idle_scene_requested.exchange(false))
+        {
+            std::string message = build_idle_scene_payload();
+            for (size_t i = 0; i < endpoints.size(); ++i)
+            {
+                boost::system::error_code ec;
+                if (endpoints[i].port() != 0)
+                    socket.send_to(boost::asio::buffer(message), endpoints[i], 0, ec);
+                if (ec)
+                    std::cerr << "Error sending idle scene to " << light_ips[i] << ": " << ec.message() << std::endl;
+            }
+        }
+
+        drain_acknowledgements(socket, endpoints);
+
+        if (enable_adaptive_rate && now - last_adapt_time >= std::chrono::milliseconds(ADAPTIVE_WINDOW_MS))
+        {
+            adapt_bulb_rates();
+            last_adapt_time = now;
+        }
+
+        if (now - last_stats_write >= std::chrono::seconds(1))
+        {
+            write_sender_stats();
+            flush_trace_events();
+            last_stats_write = now;
+        }
+    }
+
+    write_sender_stats();
+    flush_trace_events();
+}
+
+
+void build_effect_pipeline();
+
 void load_config(const std::string &config_path)
 {
     std::ifstream config_file(config_path);
     if (!config_file)
     {
         std::cerr << "Could not open config file: " << config_path << std::endl;
+        build_effect_pipeline();
         return;
     }
 
@@ -354,12 +1090,44 @@ void load_config(const std::string &config_path)
             beat_history_size = config["visualization"]["beat_history_size"].get<size_t>();
             std::cout << "Loaded beat_history_size: " << beat_history_size << std::endl;
         }
+        if (config["visualization"].contains("drum_break_interval_ms")) {
+            DRUM_BREAK_INTERVAL_MS = config["visualization"]["drum_break_interval_ms"].get<int>();
+            std::cout << "Loaded drum_break_interval_ms: " << DRUM_BREAK_INTERVAL_MS << std::endl;
+        }
+        if (config["visualization"].contains("color_cycle_duration_ms")) {
+            color_cycle_duration_ms = config["visualization"]["color_cycle_duration_ms"].get<int>();
+            std::cout << "Loaded color_cycle_duration_ms: " << color_cycle_duration_ms << std::endl;
+        }
 
         // Load network settings
         if (config["network"].contains("udp_port")) {
             UDP_PORT = config["network"]["udp_port"].get<int>();
             std::cout << "Loaded udp_port: " << UDP_PORT << std::endl;
         }
+        if (config["network"].contains("max_frame_age_ms")) {
+            MAX_FRAME_AGE_MS = config["network"]["max_frame_age_ms"].get<int>();
+            std::cout << "Loaded max_frame_age_ms: " << MAX_FRAME_AGE_MS << std::endl;
+        }
+        if (config["network"].contains("enable_adaptive_rate")) {
+            enable_adaptive_rate = config["network"]["enable_adaptive_rate"].get<bool>();
+            std::cout << "Loaded enable_adaptive_rate: " << enable_adaptive_rate << std::endl;
+        }
+        if (config["network"].contains("adaptive_min_interval_ms")) {
+            ADAPTIVE_MIN_INTERVAL_MS = config["network"]["adaptive_min_interval_ms"].get<int>();
+            std::cout << "Loaded adaptive_min_interval_ms: " << ADAPTIVE_MIN_INTERVAL_MS << std::endl;
+        }
+        if (config["network"].contains("adaptive_max_interval_ms")) {
+            ADAPTIVE_MAX_INTERVAL_MS = config["network"]["adaptive_max_interval_ms"].get<int>();
+            std::cout << "Loaded adaptive_max_interval_ms: " << ADAPTIVE_MAX_INTERVAL_MS << std::endl;
+        }
+        if (config["network"].contains("enable_metrics")) {
+            enable_metrics = config["network"]["enable_metrics"].get<bool>();
+            std::cout << "Loaded enable_metrics: " << enable_metrics << std::endl;
+        }
+        if (config["network"].contains("metrics_port")) {
+            METRICS_PORT = config["network"]["metrics_port"].get<int>();
+            std::cout << "Loaded metrics_port: " << METRICS_PORT << std::endl;
+        }
 
         // Ensure light_ips is a list, if it's not, initialize it as an empty array
         auto light_ips_json = config["network"].value("light_ips", json::array());
@@ -402,6 +1170,72 @@ void load_config(const std::string &config_path)
             enable_beat_detection = config["features"]["enable_beat_detection"].get<bool>();
             std::cout << "Loaded enable_beat_detection: " << enable_beat_detection << std::endl;
         }
+        if (config["features"].contains("enable_idle_mode")) {
+            enable_idle_mode = config["features"]["enable_idle_mode"].get<bool>();
+            std::cout << "Loaded enable_idle_mode: " << enable_idle_mode << std::endl;
+        }
+        if (config["features"].contains("idle_timeout_s")) {
+            IDLE_TIMEOUT_S = config["features"]["idle_timeout_s"].get<float>();
+            std::cout << "Loaded idle_timeout_s: " << IDLE_TIMEOUT_S << std::endl;
+        }
+        if (config["features"].contains("idle_noise_floor")) {
+            IDLE_NOISE_FLOOR = config["features"]["idle_noise_floor"].get<float>();
+            std::cout << "Loaded idle_noise_floor: " << IDLE_NOISE_FLOOR << std::endl;
+        }
+        if (config["features"].contains("idle_decimation")) {
+            IDLE_DECIMATION = std::max(1, config["features"]["idle_decimation"].get<int>());
+            std::cout << "Loaded idle_decimation: " << IDLE_DECIMATION << std::endl;
+        }
+        if (config["features"].contains("idle_scene_id")) {
+            IDLE_SCENE_ID = config["features"]["idle_scene_id"].get<int>();
+            std::cout << "Loaded idle_scene_id: " << IDLE_SCENE_ID << std::endl;
+        }
+
+        // Load effect pipeline settings
+        if (config.contains("effects")) {
+            if (config["effects"].contains("pipeline")) {
+                effect_pipeline_names = config["effects"]["pipeline"].get<std::vector<std::string>>();
+                std::cout << "Loaded effect pipeline with " << effect_pipeline_names.size() << " stages" << std::endl;
+            }
+            if (config["effects"].contains("stage_budget_us")) {
+                EFFECT_BUDGET_US = config["effects"]["stage_budget_us"].get<long long>();
+                std::cout << "Loaded stage_budget_us: " << EFFECT_BUDGET_US << std::endl;
+            }
+            if (config["effects"].contains("stage_budgets_us")) {
+                // Hand-edited; keep only numeric entries so a bad value falls back to stage_budget_us
+                const json &budgets = config["effects"]["stage_budgets_us"];
+                effect_stage_budgets = json::object();
+                if (!budgets.is_object()) {
+                    std::cerr << "stage_budgets_us must be an object of stage names to microseconds, ignoring it." << std::endl;
+                } else {
+                    for (const auto &budget : budgets.items()) {
+                        if (budget.value().is_number())
+                            effect_stage_budgets[budget.key()] = budget.value().get<long long>();
+                        else
+                            std::cerr << "Ignoring non-numeric stage budget for " << budget.key() << ": " << budget.value().dump() << std::endl;
+                    }
+                }
+                std::cout << "Loaded stage_budgets_us: " << effect_stage_budgets.dump() << std::endl;
+            }
+            if (config["effects"].contains("max_overruns")) {
+                EFFECT_MAX_OVERRUNS = std::max(1, config["effects"]["max_overruns"].get<int>());
+                std::cout << "Loaded max_overruns: " << EFFECT_MAX_OVERRUNS << std::endl;
+            }
+            if (config["effects"].contains("drum_color_step_ms")) {
+                DRUM_COLOR_STEP_MS = config["effects"]["drum_color_step_ms"].get<int>();
+                std::cout << "Loaded drum_color_step_ms: " << DRUM_COLOR_STEP_MS << std::endl;
+            }
+            if (config["effects"].contains("beat_window_ms")) {
+                BEAT_WINDOW_MS = config["effects"]["beat_window_ms"].get<int>();
+                std::cout << "Loaded beat_window_ms: " << BEAT_WINDOW_MS << std::endl;
+            }
+        }
+
+        // Load debug settings
+        if (config.contains("debug") && config["debug"].contains("enable_tracing")) {
+            tracing_enabled = config["debug"]["enable_tracing"].get<bool>();
+            std::cout << "Loaded enable_tracing: " << tracing_enabled << std::endl;
+        }
 
         // Load color settings
         if (config["color_settings"].contains("vivid_colors"))
@@ -438,11 +1272,14 @@ void load_config(const std::string &config_path)
     {
         std::cerr << "Error parsing config file: " << e.what() << std::endl;
     }
+
+    build_effect_pipeline();
 }
 
 
 bool detect_drum_break(float volume)
 {
+    TraceSpan span("detect_drum_break");
     static std::deque<float> volume_history;
     static auto last_drum_break_time = std::chrono::steady_clock::now();
 
@@ -463,6 +1300,7 @@ bool detect_drum_break(float volume)
     if (volume > threshold && elapsed_time.count() > DRUM_BREAK_INTERVAL_MS)
     {
         last_drum_break_time = now;
+        count_metric(local_metrics().drum_breaks);
         std::cout << "Drum break detected, triggering intense visual effect!" << std::endl;
         return true;
     }
@@ -472,6 +1310,7 @@ bool detect_drum_break(float volume)
 
 bool detect_beat(float volume)
 {
+    TraceSpan span("detect_beat");
     static std::deque<float> volume_history;
     static auto last_beat_time = std::chrono::steady_clock::now();
 
@@ -492,6 +1331,7 @@ bool detect_beat(float volume)
     if (volume > threshold && elapsed_time.count() > color_cycle_duration_ms)
     {
         last_beat_time = now;
+        count_metric(local_metrics().beats);
         std::cout << "BEAT DETECTED, applying colors!" << std::endl;
         return true;
     }
@@ -500,36 +1340,206 @@ bool detect_beat(float volume)
 }
 
 
+void effect_vivid_color(FrameState &frame)
+{
+    get_vivid_color_from_volume(frame.volume, frame.color);
+}
+
+void effect_dynamic_brightness(FrameState &frame)
+{
+    if (!enable_dynamic_brightness)
+        return;
+
+    float normalized_volume = clamp(frame.volume / max_seen_volume, 0.0f, 1.0f);
+    int brightness = static_cast<int>(std::pow(normalized_volume, 1.5f) * user_brightness.load());
+    frame.brightness = clamp(std::max(brightness, min_brightness.load()), min_brightness.load(), 255);
+}
+
+void effect_drum_break(FrameState &frame)
+{
+    if (enable_drum_break_detection && detect_drum_break(frame.volume)) {
+        is_drum_break_active = true;
+        last_drum_break_time = frame.now;
+    }
+
+    if (is_drum_break_active) {
+        auto drum_break_elapsed = std::chrono::duration_cast<std::chrono::milliseconds>(frame.now - last_drum_break_time);
+        if (drum_break_elapsed.count() < DRUM_BREAK_INTERVAL_MS && !drum_break_colors.empty()) {
+            const auto &drum_color = drum_break_colors[(drum_break_elapsed.count() / std::max(DRUM_COLOR_STEP_MS, 1)) % drum_break_colors.size()];
+            frame.color.assign(drum_color.begin(), drum_color.end());
+            frame.brightness = 255;
+        } else {
+            is_drum_break_active = false;
+        }
+    }
+}
+
+void effect_beat(FrameState &frame)
+{
+    if (!is_drum_break_active && enable_beat_detection && detect_beat(frame.volume)) {
+        is_beat_active = true;
+        last_beat_time = frame.now;
+        beat_index = 0;
+    }
+
+    if (is_beat_active) {
+        auto beat_elapsed = std::chrono::duration_cast<std::chrono::milliseconds>(frame.now - last_beat_time);
+        if (beat_elapsed.count() < BEAT_WINDOW_MS && !beat_colors.empty()) {
+            const auto &beat_color = beat_colors[beat_index % beat_colors.size()];
+            frame.color.assign(beat_color.begin(), beat_color.end());
+            beat_index++;
+        } else {
+            is_beat_active = false;
+        }
+    }
+}
+
+void reset_drum_break()
+{
+    is_drum_break_active = false;
+}
+
+void reset_beat()
+{
+    is_beat_active = false;
+}
+
+// Every stage that can be named in effects.pipeline. vivid_color is never
+// skipped: without it the lights would freeze on one color for the cooldown.
+const std::vector<EffectDefinition> available_effects = {
+    {"vivid_color", effect_vivid_color, nullptr, false},
+    {"dynamic_brightness", effect_dynamic_brightness, nullptr, true},
+    {"drum_break", effect_drum_break, reset_drum_break, true},
+    {"beat", effect_beat, reset_beat, true}
+};
+
+
+void build_effect_pipeline()
+{
+    effect_pipeline.clear();
+    for (const auto &name : effect_pipeline_names)
+    {
+        auto effect = std::find_if(available_effects.begin(), available_effects.end(),
+                                   [&name](const EffectDefinition &entry) { return entry.name == name; });
+        if (effect == available_effects.end())
+        {
+            std::cerr << "Unknown effect stage in pipeline: " << name << std::endl;
+            continue;
+        }
+        long long budget = effect_stage_budgets.value(name, EFFECT_BUDGET_US);
+        effect_pipeline.emplace_back(*effect, budget);
+    }
+}
+
+void run_effect_pipeline(FrameState &frame)
+{
+    for (auto &stage : effect_pipeline)
+    {
+        if (stage.skipped.load(std::memory_order_relaxed))
+        {
+            if (frame.now < stage.skipped_until) {
+                stage.times_skipped.fetch_add(1, std::memory_order_relaxed);
+                continue;
+            }
+            // Cooldown over, give the stage another chance
+            stage.skipped = false;
+            stage.consecutive_overruns = 0;
+            log_debug("Re-enabling effect stage: " + stage.name);
+        }
+
+        TraceSpan span(stage.name.c_str());
+        auto start = std::chrono::steady_clock::now();
+        stage.run(frame);
+        long long elapsed_us = std::chrono::duration_cast<std::chrono::microseconds>(std::chrono::steady_clock::now() - start).count();
+
+        stage.runs.fetch_add(1, std::memory_order_relaxed);
+        stage.total_us.fetch_add(elapsed_us, std::memory_order_relaxed);
+
+        if (elapsed_us <= stage.budget_us)
+        {
+            stage.consecutive_overruns = 0;
+        }
+        else if (++stage.consecutive_overruns >= EFFECT_MAX_OVERRUNS && stage.skippable)
+        {
+            // Don't leave a drum break or beat override running while the stage is skipped
+            if (stage.reset)
+                stage.reset();
+            stage.skipped = true;
+            stage.skipped_until = frame.now + std::chrono::milliseconds(EFFECT_COOLDOWN_MS);
+            log_debug("Effect stage " + stage.name + " over its " + std::to_string(stage.budget_us) +
+                      " us budget " + std::to_string(stage.consecutive_overruns) + " times in a row, skipping it.");
+        }
+    }
+}
+
+// RMS of every `step`-th sample, a cheap energy estimate for idle mode
+float decimated_rms(const float* in, unsigned long frame_count, int channels, int step)
+{
+    // Step over whole frames so every channel is checked in each sampled frame
+    float energy = 0.0f;
+    unsigned long counted = 0;
+    for (unsigned long frame = 0; frame < frame_count; frame += std::max(step, 1)) {
+        for (int channel = 0; channel < channels; ++channel) {
+            float sample = in[frame * channels + channel];
+            energy += sample * sample;
+        }
+        counted += channels;
+    }
+    return counted ? std::sqrt(energy / counted) : 0.0f;
+}
+
 // Callback function for PortAudio
 static int audio_callback(const void* inputBuffer, void* outputBuffer,
     unsigned long framesPerBuffer, const PaStreamCallbackTimeInfo* timeInfo,
     PaStreamCallbackFlags statusFlags, void* userData) {
 
-    std::cout << "Callback started..." << std::endl;
-
     // Check if input buffer is null
     if (inputBuffer == nullptr) {
         std::cerr << "Input buffer is null. Skipping processing." << std::endl;
         return paContinue;
     }
 
-    // Convert input buffer to audio data
+    TraceSpan callback_span("audio_callback");
+    ThreadMetrics &metrics = local_metrics();
+    count_metric(metrics.callbacks);
     const float* in = (const float*)inputBuffer;
-    audio_data.resize(framesPerBuffer * NUM_CHANNELS);
+    unsigned long sample_count = framesPerBuffer * NUM_CHANNELS;
 
-    // Check for silence in the input buffer
+    // While idle only check the energy; the first loud buffer is processed in full
+    if (is_idle) {
+        if (decimated_rms(in, framesPerBuffer, NUM_CHANNELS, IDLE_DECIMATION) < IDLE_NOISE_FLOOR) {
+            count_metric(metrics.silent_buffers);
+            return paContinue;
+        }
+        is_idle = false;
+        last_sound_time = std::chrono::steady_clock::now();
+        log_debug("Audio resumed, leaving idle mode.");
+    }
+
+    // Convert input buffer to audio data, measuring its energy on the way
+    audio_data.resize(sample_count);
+    float energy = 0.0f;
     bool is_silent = true;
-    for (unsigned int i = 0; i < framesPerBuffer * NUM_CHANNELS; i++) {
+    for (unsigned long i = 0; i < sample_count; i++) {
         audio_data[i] = static_cast<int16_t>(in[i] * 32767.0f);
+        energy += in[i] * in[i];
         if (audio_data[i] != 0) {
             is_silent = false;  // Detected non-zero data
         }
     }
 
-    if (is_silent) {
-        std::cout << "Silence detected. Skipping processing." << std::endl;
-        return paContinue;  // Skip further processing
+    // Buffers below the noise floor are silence: skip them without logging
+    auto buffer_time = std::chrono::steady_clock::now();
+    if (is_silent || std::sqrt(energy / sample_count) < IDLE_NOISE_FLOOR) {
+        auto quiet_for = std::chrono::duration<float>(buffer_time - last_sound_time);
+        if (enable_idle_mode && quiet_for.count() >= IDLE_TIMEOUT_S) {
+            log_debug("No audio for " + std::to_string(IDLE_TIMEOUT_S) + " s, entering idle mode.");
+            enter_idle_mode();
+        }
+        count_metric(metrics.silent_buffers);
+        return paContinue;
     }
+    last_sound_time = buffer_time;
 
     // Calculate volume
     float volume = process_audio(audio_data);
@@ -537,65 +1547,27 @@ static int audio_callback(const void* inputBuffer, void* outputBuffer,
     // Silence threshold check
     const float silence_threshold = 0.01f;  // Adjust as needed
     if (volume < silence_threshold) {
-        std::cout << "Volume below threshold (" << volume << "). Skipping processing." << std::endl;
+        count_metric(metrics.silent_buffers);
         return paContinue;
     }
 
-    // Process vivid color and brightness
-    std::vector<int> color = get_vivid_color_from_volume(volume);
-    int brightness = user_brightness.load();
-
-    if (enable_dynamic_brightness) {
-        float normalized_volume = clamp(volume / max_seen_volume, 0.0f, 1.0f);
-        brightness = static_cast<int>(std::pow(normalized_volume, 1.5f) * user_brightness.load());
-        brightness = std::max(brightness, min_brightness.load());
-    }
-
-    brightness = clamp(brightness, min_brightness.load(), 255);
-
-    // Drum break detection
-    bool drum_break_detected = enable_drum_break_detection && detect_drum_break(volume);
-    if (drum_break_detected) {
-        is_drum_break_active = true;
-        last_drum_break_time = std::chrono::steady_clock::now();
-    }
-
-    if (is_drum_break_active) {
-        auto now = std::chrono::steady_clock::now();
-        auto drum_break_elapsed = std::chrono::duration_cast<std::chrono::milliseconds>(now - last_drum_break_time);
-        if (drum_break_elapsed.count() < DRUM_BREAK_INTERVAL_MS) {
-            color = drum_break_colors[(drum_break_elapsed.count() / 50) % drum_break_colors.size()];
-            brightness = 255;
-        } else {
-            is_drum_break_active = false;
-        }
-    }
-
-    // Beat detection
-    bool beat_detected = !is_drum_break_active && enable_beat_detection && detect_beat(volume);
-    if (beat_detected) {
-        is_beat_active = true;
-        last_beat_time = std::chrono::steady_clock::now();
-        beat_index = 0;
-    }
+    std::cout << "Callback started..." << std::endl;
 
-    if (is_beat_active) {
-        auto now = std::chrono::steady_clock::now();
-        auto beat_elapsed = std::chrono::duration_cast<std::chrono::milliseconds>(now - last_beat_time);
-        if (beat_elapsed.count() < 1000) {
-            color = beat_colors[beat_index % beat_colors.size()];
-            beat_index++;
-        } else {
-            is_beat_active = false;
-        }
-    }
+    // Run the configured effect stages over the reused frame state
+    static FrameState frame;
+    frame.volume = volume;
+    frame.brightness = clamp(user_brightness.load(), min_brightness.load(), 255);
+    frame.now = std::chrono::steady_clock::now();
+    run_effect_pipeline(frame);
 
     // Update lights if minimum interval has passed
     auto now = std::chrono::steady_clock::now();
     auto elapsed_time = std::chrono::duration_cast<std::chrono::milliseconds>(now - last_update_time);
 
-    if (elapsed_time.count() >= MIN_UPDATE_INTERVAL_MS) {
-        send_udp_command(color, brightness);
+    // With adaptive rates each bulb is paced by the sender; produce frames for the fastest one
+    int update_interval_ms = enable_adaptive_rate ? std::min(ADAPTIVE_MIN_INTERVAL_MS, MIN_UPDATE_INTERVAL_MS) : MIN_UPDATE_INTERVAL_MS;
+    if (elapsed_time.count() >= update_interval_ms) {
+        queue_frame(frame.color, frame.brightness);
         last_update_time = now;
     }
 
@@ -626,6 +1598,7 @@ void audio_processing_loop(const std::string& light_ip) {
 
     // Function to initialize the PortAudio stream
     auto initialize_stream = [&]() -> bool {
+        TraceSpan span("initialize_stream");
         err = Pa_Initialize();
         if (err != paNoError) {
             log_debug("Fatal error Initializing PortAudio.");
@@ -735,6 +1708,8 @@ void audio_processing_loop(const std::string& light_ip) {
 
 
 
+// The benchmark suite includes this file directly and provides its own main
+#ifndef WIZ_VISUALIZER_NO_MAIN
 int main(int argc, char* argv[]) {
     log_debug("Starting main function...");
     
@@ -774,13 +1749,57 @@ int main(int argc, char* argv[]) {
     load_config(config_file_path);
     log_debug("Config loaded successfully.");
 
+    std::string::size_type config_dir_end = config_file_path.find_last_of("\\/");
+    std::string config_dir = config_dir_end != std::string::npos ? config_file_path.substr(0, config_dir_end + 1) : "";
+    STATS_FILE_PATH = config_dir + "wiz_vis_stats.json";
+
+    // WIZ_TRACE=1 traces next to the config file, 0/false/no turns tracing off,
+    // any other value names the output folder
+    std::string trace_dir = config_dir;
+    const char* trace_env = std::getenv("WIZ_TRACE");
+    std::string trace_value = trace_env != nullptr ? trace_env : "";
+    if (trace_value == "0" || trace_value == "false" || trace_value == "no") {
+        tracing_enabled = false;
+    } else if (!trace_value.empty()) {
+        tracing_enabled = true;
+        if (trace_value != "1" && trace_value != "true" && trace_value != "yes") {
+            std::string error;
+            if (create_directories(trace_value, error))
+                trace_dir = trace_value + "/";
+            else
+                std::cerr << "Could not create trace folder " << trace_value << ": " << error << ". Writing next to the config file." << std::endl;
+        }
+    }
+    TRACE_FILE_PATH = trace_dir + "wiz_vis_trace.json";
+    if (tracing_enabled)
+        log_debug("Tracing enabled, writing to: " + TRACE_FILE_PATH);
+
+    std::thread sender_thread(udp_sender_loop);
+    log_debug("Sender thread started.");
+
+    std::thread metrics_thread;
+    if (enable_metrics) {
+        metrics_thread = std::thread(metrics_server_loop);
+        log_debug("Metrics thread started.");
+    }
+
     std::thread audio_thread(audio_processing_loop, LIGHT_IP);
     log_debug("Audio thread started.");
     audio_thread.join();
     log_debug("Audio thread joined.");
 
+    running = false;
+    frame_ready.notify_one();
+    sender_thread.join();
+    log_debug("Sender thread joined.");
+    if (metrics_thread.joinable()) {
+        metrics_thread.join();
+        log_debug("Metrics thread joined.");
+    }
+
     return 0;
 }
+#endif
 
 
 